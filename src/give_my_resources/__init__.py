@@ -1,5 +1,10 @@
 """
 give-my-resources - A CLI tool for resource management
 """
+import logging
 
-__version__ = "0.1.0"
\ No newline at end of file
+__version__ = "0.1.0"
+
+# Library modules log through this logger; only `gmr agent` attaches a real handler,
+# so the interactive menu is never interrupted by log output.
+logging.getLogger(__name__).addHandler(logging.NullHandler())
\ No newline at end of file
@@ -0,0 +1,193 @@
+"""
+CPU core and NUMA node allocation for concurrent jobs
+"""
+import glob
+import logging
+import os
+import re
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+import psutil
+
+from .config import get_setting
+
+# Defaults for the settings read via get_setting
+DEFAULT_MAX_JOBS = 1
+DEFAULT_RESERVED_CORES = 1
+
+logger = logging.getLogger(__name__)
+
+def _parse_cpulist(text: str) -> List[int]:
+    """Parse a kernel cpulist like '0-3,8-11'"""
+    cpus = []
+    for part in text.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            start, end = part.split('-')
+            cpus.extend(range(int(start), int(end) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+def numa_nodes() -> List[List[int]]:
+    """
+    CPUs grouped by NUMA node, limited to the CPUs this process may run on.
+    Hosts without NUMA information are treated as one node
+    """
+    try:
+        usable = set(psutil.Process().cpu_affinity())
+    except (AttributeError, psutil.Error):
+        usable = set(range(psutil.cpu_count(logical=True) or 1))
+
+    nodes = []
+    for path in sorted(glob.glob('/sys/devices/system/node/node[0-9]*/cpulist'),
+                       key=lambda p: int(re.search(r'node(\d+)', p).group(1))):
+        try:
+            with open(path, 'r') as f:
+                cpus = [c for c in _parse_cpulist(f.read()) if c in usable]
+        except (OSError, ValueError):
+            continue
+        if cpus:
+            nodes.append(cpus)
+    return nodes or [sorted(usable)]
+
+def physical_cores(cpus: List[int]) -> List[List[int]]:
+    """
+    Group CPUs into physical cores by their SMT (hyperthread) siblings. CPUs without
+    topology information count as cores of their own
+    """
+    cpu_set = set(cpus)
+    cores = []
+    seen = set()
+    for cpu in cpus:
+        if cpu in seen:
+            continue
+        try:
+            with open(f'/sys/devices/system/cpu/cpu{cpu}/topology/thread_siblings_list', 'r') as f:
+                siblings = [c for c in _parse_cpulist(f.read()) if c in cpu_set]
+        except (OSError, ValueError):
+            siblings = []
+        core = sorted(set(siblings) | {cpu})
+        seen.update(core)
+        cores.append(core)
+    return cores
+
+def affinity_supported() -> bool:
+    """psutil only supports setting affinity on Linux, Windows and FreeBSD"""
+    return hasattr(psutil.Process, 'cpu_affinity')
+
+@contextmanager
+def spawn_affinity(cpus: List[int]) -> Iterator[None]:
+    """
+    Pin the calling thread while it starts a job, so the job inherits the CPUs from
+    its first instruction (e.g. node's startup threads) instead of being pinned
+    after the fact. Only where os.sched_setaffinity exists; elsewhere pin() does it
+    """
+    previous = None
+    if cpus and hasattr(os, 'sched_setaffinity'):
+        try:
+            previous = os.sched_getaffinity(0)
+            os.sched_setaffinity(0, cpus)
+        except OSError as e:
+            logger.warning("Could not set job CPU affinity: %s", e)
+            previous = None
+    try:
+        yield
+    finally:
+        if previous is not None:
+            os.sched_setaffinity(0, previous)
+
+class CoreAllocator:
+    """
+    Hands each job a dedicated set of physical cores (with all their SMT siblings),
+    preferring a single NUMA node, and keeps the first core(s) of node 0 for the
+    agent and the device owner
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Per node, its physical cores, each a list of logical CPUs
+        self.nodes = [physical_cores(cpus) for cpus in numa_nodes()]
+        reserved = int(get_setting('reserved_cores', DEFAULT_RESERVED_CORES))
+        total = sum(len(cores) for cores in self.nodes)
+        # Never reserve everything: a single-core host still runs jobs
+        reserved = min(reserved, total - 1) if total > 1 else 0
+        self.reserved = [cpu for core in self.nodes[0][:reserved] for cpu in core]
+        self.max_jobs = max(1, int(get_setting('max_jobs', DEFAULT_MAX_JOBS)))
+        job_cores = total - reserved
+        self.cores_per_job = max(1, int(get_setting('cores_per_job', 0)) or job_cores // self.max_jobs)
+        self.allocations: Dict[str, Dict] = {}
+
+    def _free_by_node(self) -> List[List[List[int]]]:
+        """Physical cores none of whose CPUs are reserved or allocated, per node"""
+        taken = set(self.reserved)
+        for allocation in self.allocations.values():
+            taken.update(allocation['cores'])
+        return [[core for core in cores if not taken.intersection(core)] for cores in self.nodes]
+
+    def free_slots(self) -> int:
+        with self._lock:
+            return self.max_jobs - len(self.allocations)
+
+    def allocate(self, job_id: str) -> Optional[Dict]:
+        """
+        Reserve cores for a job
+
+        Returns:
+            {'cores': [...], 'node': n or None} or None if all job slots are taken.
+            'cores' lists logical CPUs, and is empty when the platform can't pin processes
+        """
+        with self._lock:
+            if len(self.allocations) >= self.max_jobs:
+                return None
+            if not affinity_supported():
+                allocation = {'cores': [], 'node': None}
+                self.allocations[job_id] = allocation
+                return allocation
+
+            free = self._free_by_node()
+            # Smallest node that fits the whole job keeps bigger nodes free for bigger jobs
+            fitting = [i for i, cores in enumerate(free) if len(cores) >= self.cores_per_job]
+            if fitting:
+                node = min(fitting, key=lambda i: len(free[i]))
+                cores = free[node][:self.cores_per_job]
+            else:
+                # Spread over nodes, most free first; None marks a cross-node allocation
+                node = None
+                cores = []
+                for node_cores in sorted(free, key=len, reverse=True):
+                    cores.extend(node_cores[:self.cores_per_job - len(cores)])
+                if not cores:
+                    # Oversubscribed: share the non-reserved cores rather than refuse the job
+                    cores = [core for node_cores in self.nodes for core in node_cores
+                             if not set(core) & set(self.reserved)]
+            allocation = {'cores': sorted(cpu for core in cores for cpu in core), 'node': node}
+            self.allocations[job_id] = allocation
+            return allocation
+
+    def release(self, job_id: str):
+        with self._lock:
+            self.allocations.pop(job_id, None)
+
+    def pin(self, job_id: str, pid: int):
+        """Apply a job's core allocation to its process, where spawn_affinity couldn't"""
+        allocation = self.allocations.get(job_id)
+        if not allocation or not allocation['cores'] or hasattr(os, 'sched_setaffinity'):
+            return
+        try:
+            psutil.Process(pid).cpu_affinity(allocation['cores'])
+        except (psutil.Error, OSError, ValueError) as e:
+            logger.warning("Could not set job CPU affinity: %s", e)
+
+    def snapshot(self) -> Dict:
+        """Allocation summary for heartbeat metrics"""
+        with self._lock:
+            return {
+                'numa_nodes': len(self.nodes),
+                'reserved_cores': self.reserved,
+                'cores_per_job': self.cores_per_job,
+                'jobs': {job_id: dict(a) for job_id, a in self.allocations.items()},
+            }
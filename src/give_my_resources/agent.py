@@ -0,0 +1,169 @@
+"""
+Headless agent mode for give-my-resources
+"""
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Optional
+
+import psutil
+
+from .config import (
+    CONFIG_DIR, ensure_config_dir, write_atomic,
+    get_user_id, set_device_status, set_tunnel_url
+)
+from .heartbeat import HeartbeatMonitor
+
+PID_FILE = CONFIG_DIR / 'agent.pid'
+STATUS_FILE = CONFIG_DIR / 'agent-status.json'
+
+# Seconds between status file refreshes
+STATUS_INTERVAL = 5
+
+logger = logging.getLogger(__name__)
+
+def _utc_now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+class JsonFormatter(logging.Formatter):
+    """Format log records as one JSON object per line"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        # Structured fields passed as extra={'fields': {...}}
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+def setup_logging(level: str = "INFO", log_format: str = "json"):
+    """Send package logs to stderr, where systemd/journald picks them up"""
+    handler = logging.StreamHandler(sys.stderr)
+    if log_format == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level.upper())
+
+class Agent:
+    """Runs the heartbeat, job intake and executor without the interactive menu"""
+
+    def __init__(self, pid_file: Path = PID_FILE, status_file: Path = STATUS_FILE,
+                 drain_timeout: Optional[float] = 60):
+        self.pid_file = Path(pid_file)
+        self.status_file = Path(status_file)
+        self.drain_timeout = drain_timeout
+        self.monitor = HeartbeatMonitor()
+        self.state = "starting"
+        self.started_at = _utc_now()
+        self._shutdown = threading.Event()
+        self._signal_count = 0
+
+    def _handle_signal(self, signum, frame):
+        self._signal_count += 1
+        if self._signal_count > 1:
+            # A second signal means the operator doesn't want to wait for the drain
+            logger.warning("Second signal received, exiting without draining",
+                           extra={'fields': {'signal': signum}})
+            self.monitor.kill_jobs()
+            self._remove_pid_file()
+            os._exit(1)
+        logger.info("Shutdown requested", extra={'fields': {'signal': signum}})
+        self._shutdown.set()
+
+    def _acquire_pid_file(self) -> bool:
+        """Write the pid file, refusing to start if another agent is alive"""
+        if self.pid_file.exists():
+            try:
+                other_pid = int(self.pid_file.read_text().strip())
+            except (ValueError, OSError):
+                other_pid = None
+            if other_pid and other_pid != os.getpid() and psutil.pid_exists(other_pid):
+                logger.error("Another agent is already running",
+                             extra={'fields': {'pid': other_pid, 'pid_file': str(self.pid_file)}})
+                return False
+        self.pid_file.parent.mkdir(parents=True, exist_ok=True)
+        write_atomic(self.pid_file, f"{os.getpid()}\n")
+        return True
+
+    def _remove_pid_file(self):
+        try:
+            if self.pid_file.exists() and self.pid_file.read_text().strip() == str(os.getpid()):
+                self.pid_file.unlink()
+        except OSError:
+            pass
+
+    def write_status(self):
+        """Write the current agent state for operators and health checks"""
+        status = {
+            "pid": os.getpid(),
+            "state": self.state,
+            "device_status": self.monitor.status,
+            "user_id": get_user_id(),
+            "running_jobs": list(self.monitor.jobs),
+            "started_at": self.started_at,
+            "updated_at": _utc_now(),
+        }
+        try:
+            self.status_file.parent.mkdir(parents=True, exist_ok=True)
+            write_atomic(self.status_file, json.dumps(status, indent=2))
+        except OSError as e:
+            logger.warning("Could not write status file: %s", e)
+
+    def run(self) -> int:
+        """Run until SIGTERM/SIGINT, then drain and exit. Returns the process exit code"""
+        ensure_config_dir()
+        if not get_user_id():
+            logger.error("No user ID configured; run `gmr agent --user-id <id>` or `gmr` once to sign up")
+            return 2
+        if not self._acquire_pid_file():
+            return 1
+
+        signal.signal(signal.SIGTERM, self._handle_signal)
+        signal.signal(signal.SIGINT, self._handle_signal)
+
+        try:
+            # Headless boxes are there to contribute, and have no tunnel
+            set_device_status(True)
+            set_tunnel_url("")
+            self.monitor.start()
+            self.state = "running"
+            logger.info("Agent started", extra={'fields': {'pid': os.getpid(), 'user_id': get_user_id()}})
+
+            failed = False
+            while not self._shutdown.is_set():
+                if not self.monitor.is_alive():
+                    # Exit non-zero so the service manager restarts the agent
+                    logger.error("Heartbeat loop stopped unexpectedly, shutting down")
+                    failed = True
+                    break
+                self.write_status()
+                self._shutdown.wait(STATUS_INTERVAL)
+
+            self.state = "draining"
+            self.write_status()
+            started = time.monotonic()
+            drained = self.monitor.drain(timeout=self.drain_timeout)
+            if drained:
+                logger.info("Drain complete", extra={'fields': {'seconds': round(time.monotonic() - started, 2)}})
+            else:
+                logger.warning("Drain timed out, running jobs cancelled",
+                               extra={'fields': {'job_ids': list(self.monitor.jobs)}})
+            self.state = "failed" if failed else "stopped"
+            self.write_status()
+            return 0 if drained and not failed else 1
+        finally:
+            self._remove_pid_file()
@@ -0,0 +1,304 @@
+"""
+Job output artifacts: content-hashed resumable upload and parallel ranged download
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path, PurePosixPath
+from typing import Dict, List, Optional
+
+import requests
+
+from .bundle import CHUNK_SIZE, file_sha256
+from .config import CONFIG_DIR, API_BASE_URL, write_atomic
+
+ARTIFACT_SPOOL_DIR = CONFIG_DIR / 'artifacts'
+STATE_NAME = 'upload.json'
+
+# Artifacts are uploaded and verified in CHUNK_SIZE chunks (as bundles are); the chunk hash is its address
+
+# Attempts per chunk before leaving the upload for a later resume
+UPLOAD_ATTEMPTS = 4
+
+# Parallel ranged requests per download
+DOWNLOAD_WORKERS = 4
+
+# Reserved artifact prefix for agent-produced files such as truncated stdout/stderr
+OUTPUT_PREFIX = '_gmr/'
+
+logger = logging.getLogger(__name__)
+
+class ArtifactError(Exception):
+    """Raised when artifacts cannot be collected, uploaded or downloaded"""
+
+def safe_name(name: str) -> str:
+    """Normalize an artifact name, rejecting anything that could escape a directory"""
+    path = PurePosixPath(name.replace('\\', '/'))
+    if path.is_absolute() or '..' in path.parts or not path.parts:
+        raise ArtifactError(f"Unsafe artifact name: {name}")
+    return path.as_posix()
+
+def collect_artifacts(patterns: List[str], sandbox: Path, dest: Path) -> Dict[str, Path]:
+    """
+    Move files matching the job's declared artifact patterns out of the sandbox
+    before it is deleted
+
+    Returns:
+        Mapping of artifact name (path relative to the sandbox) to its new location
+    """
+    sandbox = sandbox.resolve()
+    collected = {}
+    for pattern in patterns:
+        try:
+            matches = sorted(sandbox.glob(pattern))
+        except (ValueError, NotImplementedError):
+            logger.warning("Ignoring invalid artifact pattern", extra={'fields': {'pattern': pattern}})
+            continue
+        for path in matches:
+            if path.is_symlink() or not path.is_file():
+                continue
+            resolved = path.resolve()
+            if sandbox not in resolved.parents:
+                continue
+            name = resolved.relative_to(sandbox).as_posix()
+            if name in collected:
+                continue
+            target = dest / name
+            target.parent.mkdir(parents=True, exist_ok=True)
+            shutil.move(str(resolved), str(target))
+            collected[name] = target
+    return collected
+
+def _chunk_hashes(path: Path) -> List[str]:
+    hashes = []
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(CHUNK_SIZE), b''):
+            hashes.append(hashlib.sha256(block).hexdigest())
+    return hashes
+
+# One lock per job, so the job's own thread and the resume thread never upload it at once
+_upload_locks: Dict[str, threading.Lock] = {}
+_upload_locks_lock = threading.Lock()
+
+def _upload_lock(job_id: str) -> threading.Lock:
+    with _upload_locks_lock:
+        return _upload_locks.setdefault(job_id, threading.Lock())
+
+class ArtifactUpload:
+    """
+    A job's artifacts staged on disk with their upload progress, so an upload
+    interrupted by a network drop or an agent restart picks up where it stopped
+    """
+
+    def __init__(self, job_dir: Path, state: Dict):
+        self.job_dir = job_dir
+        self.state = state
+
+    @property
+    def job_id(self) -> str:
+        return self.state['job_id']
+
+    @property
+    def names(self) -> List[str]:
+        return sorted(self.state['files'])
+
+    @classmethod
+    def stage(cls, job_id: str, files: Dict[str, Path]) -> 'ArtifactUpload':
+        """Move files into the spool and record their chunk hashes"""
+        job_dir = ARTIFACT_SPOOL_DIR / str(job_id)
+        files_dir = job_dir / 'files'
+        manifest = {}
+        for name, path in files.items():
+            name = safe_name(name)
+            target = files_dir / name
+            if Path(path) != target:
+                target.parent.mkdir(parents=True, exist_ok=True)
+                shutil.move(str(path), str(target))
+            manifest[name] = {
+                'size': target.stat().st_size,
+                'sha256': file_sha256(target),
+                'chunks': _chunk_hashes(target),
+            }
+        upload = cls(job_dir, {'job_id': str(job_id), 'files': manifest, 'uploaded': [], 'complete': False})
+        upload.save()
+        return upload
+
+    @classmethod
+    def load(cls, job_dir: Path) -> Optional['ArtifactUpload']:
+        try:
+            with open(job_dir / STATE_NAME, 'r') as f:
+                return cls(job_dir, json.load(f))
+        except (OSError, json.JSONDecodeError):
+            return None
+
+    def save(self):
+        self.job_dir.mkdir(parents=True, exist_ok=True)
+        write_atomic(self.job_dir / STATE_NAME, json.dumps(self.state))
+
+    def _upload_chunk(self, session: requests.Session, digest: str, path: Path, index: int):
+        url = f"{API_BASE_URL}/artifacts/chunks/{digest}"
+        # Content addressing makes chunks shared across jobs and retries idempotent
+        if session.head(url, timeout=5).status_code == 200:
+            return
+        with open(path, 'rb') as f:
+            f.seek(index * CHUNK_SIZE)
+            block = f.read(CHUNK_SIZE)
+        response = session.put(url, data=block, headers={'Content-Type': 'application/octet-stream'}, timeout=30)
+        response.raise_for_status()
+
+    def upload(self, wait: bool = True) -> bool:
+        """
+        Upload missing chunks, then publish the manifest
+
+        Args:
+            wait: Whether to wait if another thread is uploading this job already,
+                rather than give up
+
+        Returns:
+            bool: True once the server has every artifact
+        """
+        lock = _upload_lock(self.job_id)
+        if not lock.acquire(blocking=wait):
+            return False
+        try:
+            # Another thread may have progressed, or finished and removed the spool, meanwhile
+            if not self.job_dir.exists():
+                return True
+            current = ArtifactUpload.load(self.job_dir)
+            if current is not None:
+                self.state = current.state
+            if self.state['complete']:
+                return True
+            return self._upload()
+        finally:
+            lock.release()
+
+    def _upload(self) -> bool:
+        uploaded = set(self.state['uploaded'])
+        with requests.Session() as session:
+            for name in self.names:
+                path = self.job_dir / 'files' / name
+                for index, digest in enumerate(self.state['files'][name]['chunks']):
+                    if digest in uploaded:
+                        continue
+                    for attempt in range(UPLOAD_ATTEMPTS):
+                        try:
+                            self._upload_chunk(session, digest, path, index)
+                            break
+                        except requests.RequestException as e:
+                            if attempt == UPLOAD_ATTEMPTS - 1:
+                                logger.warning("Artifact upload interrupted, will resume",
+                                               extra={'fields': {'job_id': self.job_id, 'error': str(e)}})
+                                return False
+                            time.sleep(2 ** attempt)
+                    uploaded.add(digest)
+                    self.state['uploaded'] = sorted(uploaded)
+                    self.save()
+            try:
+                response = session.post(
+                    f"{API_BASE_URL}/artifacts/{self.job_id}/manifest",
+                    json={'chunk_size': CHUNK_SIZE, 'files': self.state['files']},
+                    timeout=10
+                )
+                response.raise_for_status()
+            except requests.RequestException as e:
+                logger.warning("Artifact manifest upload failed, will resume",
+                               extra={'fields': {'job_id': self.job_id, 'error': str(e)}})
+                return False
+        self.state['complete'] = True
+        self.save()
+        logger.info("Artifacts uploaded", extra={'fields': {'job_id': self.job_id, 'files': self.names}})
+        shutil.rmtree(self.job_dir, ignore_errors=True)
+        with _upload_locks_lock:
+            _upload_locks.pop(self.job_id, None)
+        return True
+
+_resume_lock = threading.Lock()
+
+def resume_pending_uploads():
+    """Retry uploads left over from network drops or a previous agent run"""
+    if not _resume_lock.acquire(blocking=False):
+        return  # Already resuming in another thread
+    try:
+        if not ARTIFACT_SPOOL_DIR.exists():
+            return
+        for job_dir in ARTIFACT_SPOOL_DIR.iterdir():
+            upload = ArtifactUpload.load(job_dir)
+            if upload is not None:
+                # Skip uploads in progress elsewhere, e.g. by the job that staged them
+                upload.upload(wait=False)
+    finally:
+        _resume_lock.release()
+
+def fetch_manifest(job_id: str) -> Dict:
+    try:
+        response = requests.get(f"{API_BASE_URL}/artifacts/{job_id}/manifest", timeout=10)
+        if response.status_code == 404:
+            raise ArtifactError(f"No artifacts found for job {job_id}")
+        response.raise_for_status()
+        return response.json()
+    except requests.RequestException as e:
+        raise ArtifactError(f"Could not fetch artifact list: {e}")
+
+def _download_range(session: requests.Session, url: str, part_path: Path, index: int,
+                    chunk_size: int, expected: str, size: int):
+    start = index * chunk_size
+    end = min(start + chunk_size, size) - 1
+    # Keep chunks that a previous, interrupted fetch already got right
+    with open(part_path, 'rb') as f:
+        f.seek(start)
+        if hashlib.sha256(f.read(end - start + 1)).hexdigest() == expected:
+            return
+    response = session.get(url, headers={'Range': f"bytes={start}-{end}"}, timeout=60)
+    response.raise_for_status()
+    data = response.content
+    if response.status_code == 200 and len(data) == size:
+        data = data[start:end + 1]  # Server ignored the range
+    if hashlib.sha256(data).hexdigest() != expected:
+        raise ArtifactError(f"Chunk {index} of {url} failed verification")
+    with open(part_path, 'r+b') as f:
+        f.seek(start)
+        f.write(data)
+
+def download_artifact(job_id: str, name: str, info: Dict, dest: Path, chunk_size: int,
+                      workers: int = DOWNLOAD_WORKERS) -> Path:
+    """Download one artifact with parallel ranged requests, verifying every chunk"""
+    target = dest / safe_name(name)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    part_path = target.with_name(target.name + '.part')
+    with open(part_path, 'ab') as f:
+        f.truncate(info['size'])
+
+    url = f"{API_BASE_URL}/artifacts/{job_id}/files/{name}"
+    with requests.Session() as session, ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(_download_range, session, url, part_path, index, chunk_size, digest, info['size'])
+            for index, digest in enumerate(info['chunks'])
+        ]
+        try:
+            for future in futures:
+                future.result()
+        except requests.RequestException as e:
+            raise ArtifactError(f"Download of {name} failed: {e}")
+
+    if file_sha256(part_path) != info['sha256']:
+        raise ArtifactError(f"{name} failed verification")
+    os.replace(part_path, target)
+    return target
+
+def fetch_artifacts(job_id: str, dest: Path, names: Optional[List[str]] = None,
+                    workers: int = DOWNLOAD_WORKERS) -> List[Path]:
+    """Download a job's artifacts (all, or the given names) into dest"""
+    manifest = fetch_manifest(job_id)
+    files = manifest.get('files', {})
+    chunk_size = manifest.get('chunk_size', CHUNK_SIZE)
+    wanted = names or sorted(files)
+    missing = [n for n in wanted if n not in files]
+    if missing:
+        raise ArtifactError(f"Job {job_id} has no artifact {', '.join(missing)}")
+    return [download_artifact(job_id, name, files[name], dest, chunk_size, workers) for name in wanted]
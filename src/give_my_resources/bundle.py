@@ -0,0 +1,246 @@
+"""
+Multi-file job bundles: packing, chunked upload, download cache and extraction
+"""
+import fnmatch
+import gzip
+import hashlib
+import json
+import logging
+import os
+import tarfile
+import tempfile
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import requests
+
+from .config import CONFIG_DIR, API_BASE_URL
+
+MANIFEST_NAME = 'gmr.json'
+BUNDLE_CACHE_DIR = CONFIG_DIR / 'bundles'
+
+# Upload/download in pieces so large bundles never sit in memory
+CHUNK_SIZE = 4 * 1024 * 1024
+
+# Keep at most this much of downloaded bundles on a device (MB)
+BUNDLE_CACHE_MAX_MB = 1024
+
+DEFAULT_EXCLUDE = [
+    '.git', '.hg', '.svn',
+    '__pycache__', '*.pyc',
+    '.venv', 'venv', '.tox', '.mypy_cache', '.pytest_cache',
+    '.DS_Store',
+]
+
+logger = logging.getLogger(__name__)
+
+class BundleError(Exception):
+    """Raised when a bundle cannot be built, transferred or unpacked"""
+
+def load_manifest(root: Path) -> Dict:
+    """
+    Read the bundle manifest (gmr.json) from a project directory
+
+    The manifest looks like:
+        {"entry": "main.py", "include": ["*.py", "data/*"], "exclude": ["tests"],
+         "requirements": "requirements.txt", "artifacts": ["out/*.csv"]}
+    Only "entry" is required; include defaults to everything. "requirements" is
+    either a list of requirement strings or a path to a requirements file.
+    "artifacts" are glob patterns of files the job writes that should be kept.
+    """
+    manifest_path = Path(root) / MANIFEST_NAME
+    try:
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        raise BundleError(f"No {MANIFEST_NAME} found in {root}")
+    except json.JSONDecodeError as e:
+        raise BundleError(f"Invalid {MANIFEST_NAME}: {e}")
+    if not isinstance(manifest, dict) or not manifest.get('entry'):
+        raise BundleError(f"{MANIFEST_NAME} must declare an 'entry' file")
+    if not manifest['entry'].endswith(('.py', '.js')):
+        raise BundleError("Bundle entry must be a .py or .js file")
+    return manifest
+
+def _matches(rel_path: str, patterns: List[str]) -> bool:
+    """Match a posix relative path, or any of its parent directories, against glob patterns"""
+    parts = rel_path.split('/')
+    candidates = ['/'.join(parts[:i]) for i in range(1, len(parts) + 1)] + parts
+    for pattern in patterns:
+        pattern = pattern.rstrip('/')
+        if pattern.endswith('/**'):
+            pattern = pattern[:-3]
+        if any(fnmatch.fnmatch(c, pattern) for c in candidates):
+            return True
+    return False
+
+def collect_files(root: Path, manifest: Dict) -> List[str]:
+    """List the relative paths that go into the bundle, sorted for reproducibility"""
+    root = Path(root)
+    include = manifest.get('include') or ['*']
+    exclude = DEFAULT_EXCLUDE + (manifest.get('exclude') or [])
+    files = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        rel_dir = Path(dirpath).relative_to(root).as_posix()
+        # Prune excluded directories so we don't walk into e.g. .git
+        dirnames[:] = [
+            d for d in dirnames
+            if not _matches(d if rel_dir == '.' else f"{rel_dir}/{d}", exclude)
+        ]
+        for name in filenames:
+            rel = name if rel_dir == '.' else f"{rel_dir}/{name}"
+            if _matches(rel, include) and not _matches(rel, exclude):
+                # Symlinks are stored as the file they point to (devices only unpack
+                # regular files), so one that points nowhere can't be bundled
+                if not (root / rel).is_file():
+                    raise BundleError(f"{rel} is a broken symlink or not a regular file")
+                files.append(rel)
+    if manifest['entry'] not in files:
+        raise BundleError(f"Entry file {manifest['entry']} is not included in the bundle")
+    if MANIFEST_NAME not in files:
+        files.append(MANIFEST_NAME)
+    return sorted(files)
+
+def build_bundle(root: Path) -> Tuple[Path, str, Dict]:
+    """
+    Pack a project directory into a reproducible .tar.gz
+
+    Timestamps and ownership are zeroed so unchanged projects hash the same,
+    which is what makes the server-side and device-side caches hit. Symlinked
+    files are stored as copies of their targets.
+
+    Returns:
+        Tuple of (archive path, sha256 hex digest, manifest)
+    """
+    root = Path(root)
+    manifest = load_manifest(root)
+    files = collect_files(root, manifest)
+
+    fd, archive = tempfile.mkstemp(prefix='gmr-bundle-', suffix='.tar.gz')
+    os.close(fd)
+    with open(archive, 'wb') as raw:
+        with gzip.GzipFile(filename='', fileobj=raw, mode='wb', mtime=0) as gz:
+            with tarfile.open(fileobj=gz, mode='w', format=tarfile.PAX_FORMAT) as tar:
+                for rel in files:
+                    with open(root / rel, 'rb') as f:
+                        # From the open file rather than the path, so symlinks are followed
+                        info = tar.gettarinfo(arcname=rel, fileobj=f)
+                        info.mtime = 0
+                        info.uid = info.gid = 0
+                        info.uname = info.gname = ''
+                        info.mode = 0o755 if info.mode & 0o111 else 0o644
+                        tar.addfile(info, f)
+    return Path(archive), file_sha256(archive), manifest
+
+def file_sha256(path) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(CHUNK_SIZE), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def upload_bundle(archive: Path, digest: str) -> bool:
+    """
+    Upload a bundle in chunks, skipping the upload if the server already has it
+
+    Returns:
+        bool: True if the bundle is available on the server
+    """
+    try:
+        response = requests.head(f"{API_BASE_URL}/bundles/{digest}", timeout=5)
+        if response.status_code == 200:
+            logger.info("Bundle already on server", extra={'fields': {'bundle': digest}})
+            return True
+
+        size = os.path.getsize(archive)
+        chunks = 0
+        with open(archive, 'rb') as f:
+            for index, block in enumerate(iter(lambda: f.read(CHUNK_SIZE), b'')):
+                response = requests.put(
+                    f"{API_BASE_URL}/bundles/{digest}/chunks/{index}",
+                    data=block,
+                    headers={'Content-Type': 'application/octet-stream'},
+                    timeout=30
+                )
+                response.raise_for_status()
+                chunks += 1
+
+        response = requests.post(
+            f"{API_BASE_URL}/bundles/{digest}/complete",
+            json={'chunks': chunks, 'size': size},
+            timeout=10
+        )
+        return response.status_code == 200
+    except requests.RequestException as e:
+        logger.warning("Bundle upload failed: %s", e)
+        return False
+
+def _prune_cache(keep: Optional[Path] = None):
+    """Drop least recently used bundles once the cache exceeds its size limit"""
+    entries = sorted(BUNDLE_CACHE_DIR.glob('*.tar.gz'), key=lambda p: p.stat().st_mtime)
+    total = sum(p.stat().st_size for p in entries)
+    limit = BUNDLE_CACHE_MAX_MB * 1024 * 1024
+    for path in entries:
+        if total <= limit:
+            break
+        if path == keep:
+            continue
+        total -= path.stat().st_size
+        path.unlink()
+
+def fetch_bundle(digest: str) -> Path:
+    """
+    Return a local path to the bundle, downloading it only on a cache miss
+
+    Raises:
+        BundleError: If the download fails or the content doesn't match the digest
+    """
+    if len(digest) != 64 or any(c not in '0123456789abcdef' for c in digest):
+        raise BundleError(f"Invalid bundle hash: {digest}")
+    BUNDLE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    cached = BUNDLE_CACHE_DIR / f"{digest}.tar.gz"
+    if cached.exists():
+        os.utime(cached)  # Mark as recently used
+        return cached
+
+    fd, tmp_path = tempfile.mkstemp(dir=str(BUNDLE_CACHE_DIR), suffix='.part')
+    h = hashlib.sha256()
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            with requests.get(f"{API_BASE_URL}/bundles/{digest}", stream=True, timeout=30) as response:
+                response.raise_for_status()
+                for block in response.iter_content(chunk_size=CHUNK_SIZE):
+                    h.update(block)
+                    f.write(block)
+        if h.hexdigest() != digest:
+            raise BundleError(f"Bundle {digest} failed hash verification")
+        os.replace(tmp_path, cached)
+    except requests.RequestException as e:
+        raise BundleError(f"Could not download bundle {digest}: {e}")
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    _prune_cache(keep=cached)
+    return cached
+
+def extract_bundle(archive: Path, dest: Path):
+    """
+    Unpack a bundle into the job sandbox, refusing anything that escapes it
+
+    Raises:
+        BundleError: If the archive contains links, devices or unsafe paths
+    """
+    dest = Path(dest).resolve()
+    try:
+        with tarfile.open(archive, 'r:gz') as tar:
+            members = tar.getmembers()
+            for member in members:
+                target = (dest / member.name).resolve()
+                if not (member.isfile() or member.isdir()):
+                    raise BundleError(f"Unsupported bundle entry: {member.name}")
+                if target != dest and dest not in target.parents:
+                    raise BundleError(f"Unsafe path in bundle: {member.name}")
+            tar.extractall(dest, members=members)
+    except tarfile.TarError as e:
+        raise BundleError(f"Corrupt bundle: {e}")
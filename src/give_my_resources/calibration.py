@@ -0,0 +1,124 @@
+"""
+Device performance calibration for give-my-resources
+"""
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+from typing import Dict, Optional
+
+import psutil
+
+from .config import CONFIG_DIR, ensure_config_dir, get_calibration, set_calibration
+
+# Bump when the suite changes so old cached scores are re-measured
+CALIBRATION_VERSION = 1
+
+# Re-run the suite when the cached result is older than this (seconds)
+CALIBRATION_MAX_AGE = 6 * 60 * 60
+
+# Fixed workload sizes keep the suite deterministic and short (~1-2 s)
+HASH_BLOCK = b"\xa5" * (1024 * 1024)  # 1 MiB, large enough that hashlib releases the GIL
+HASH_MB = 32
+MEMORY_MB = 64
+DISK_MB = 64
+REPEATS = 3
+
+logger = logging.getLogger(__name__)
+
+def _hash_work(mb: int):
+    h = hashlib.sha256()
+    for _ in range(mb):
+        h.update(HASH_BLOCK)
+    return h.digest()
+
+def _best_of(fn, repeats: int = REPEATS) -> float:
+    """Run fn a few times and return the fastest wall time in seconds"""
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return max(best, 1e-9)
+
+def measure_single_core() -> float:
+    """SHA-256 throughput of one core in MB/s"""
+    return HASH_MB / _best_of(lambda: _hash_work(HASH_MB))
+
+def measure_multi_core(workers: int) -> float:
+    """Aggregate SHA-256 throughput across `workers` threads in MB/s"""
+    def run():
+        threads = [threading.Thread(target=_hash_work, args=(HASH_MB,)) for _ in range(workers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    return HASH_MB * workers / _best_of(run)
+
+def measure_memory_bandwidth() -> float:
+    """Memory copy throughput in MB/s"""
+    src = bytearray(MEMORY_MB * 1024 * 1024)
+    dst = bytearray(len(src))
+    def run():
+        dst[:] = src
+    return MEMORY_MB / _best_of(run)
+
+def measure_disk_write() -> float:
+    """Sequential write throughput to the config dir's disk in MB/s, including fsync"""
+    ensure_config_dir()
+    block = HASH_BLOCK
+    fd, path = tempfile.mkstemp(prefix='calibration-', dir=str(CONFIG_DIR))
+    try:
+        def run():
+            os.lseek(fd, 0, os.SEEK_SET)
+            for _ in range(DISK_MB):
+                os.write(fd, block)
+            os.fsync(fd)
+        # Disk is slow and noisy enough that one pass is representative
+        return DISK_MB / _best_of(run, repeats=1)
+    finally:
+        os.close(fd)
+        os.remove(path)
+
+def run_calibration() -> Dict:
+    """Run the full suite and return the scores"""
+    workers = psutil.cpu_count(logical=True) or 1
+    single = measure_single_core()
+    multi = measure_multi_core(workers)
+    result = {
+        "version": CALIBRATION_VERSION,
+        "measured_at": int(time.time()),
+        "cpu_count": workers,
+        "single_core": round(single, 1),
+        "multi_core": round(multi, 1),
+        "scaling": round(multi / single, 2),
+        "memory_bandwidth": round(measure_memory_bandwidth(), 1),
+    }
+    try:
+        result["disk_write"] = round(measure_disk_write(), 1)
+    except OSError as e:
+        logger.warning("Disk calibration failed: %s", e)
+        result["disk_write"] = None
+    return result
+
+def is_stale(result: Optional[Dict]) -> bool:
+    """Whether a cached result needs re-measuring"""
+    if not result or result.get("version") != CALIBRATION_VERSION:
+        return True
+    # Hardware changes (e.g. VM resized) invalidate the scores
+    if result.get("cpu_count") != (psutil.cpu_count(logical=True) or 1):
+        return True
+    return time.time() - result.get("measured_at", 0) > CALIBRATION_MAX_AGE
+
+def calibrate_if_stale(force: bool = False) -> Optional[Dict]:
+    """Run the suite if the cached result is missing or old, and cache it"""
+    cached = get_calibration()
+    if not force and not is_stale(cached):
+        return cached
+    logger.info("Running performance calibration")
+    result = run_calibration()
+    set_calibration(result)
+    logger.info("Calibration complete", extra={'fields': result})
+    return result
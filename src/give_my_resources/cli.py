@@ -10,6 +10,9 @@ import shutil
 import subprocess
 import platform
 import atexit
+import tempfile
+import time
+from pathlib import Path
 from typing import List, Dict, Optional
 try:
     from pyngrok import ngrok, conf, exception as ngrok_exception
@@ -28,9 +31,19 @@ from .config import (
     get_ngrok_token, set_ngrok_token,
     get_ngrok_id, set_ngrok_id,
     set_tunnel_url,
+    get_setting, set_setting, SETTING_TYPES,
     API_BASE_URL
 )
 from .heartbeat import HeartbeatMonitor, LOCAL_PORT
+from .agent import Agent, PID_FILE, STATUS_FILE, setup_logging
+from . import memo, tracing, profiling
+from .menudata import MenuData, freshness
+from .artifacts import OUTPUT_PREFIX, DOWNLOAD_WORKERS, ArtifactError, fetch_artifacts
+from .bundle import MANIFEST_NAME, BundleError, load_manifest, collect_files
+from .submit import (
+    build_job, submit_job, cancel_job, fetch_jobs, wait_for_job,
+    count_file_lines, count_bundle_lines, calculate_price
+)
 
 WEB_APP_URL = "https://vibe25-resourcesharing-web-app.vercel.app/handler/sign-up"
 
@@ -51,44 +64,52 @@ def cleanup_ngrok():
 atexit.register(cleanup_ngrok)
 
 def fetch_resources() -> List[Dict]:
-    try:
-        response = requests.get(f"{API_BASE_URL}/devices", timeout=5)
-        response.raise_for_status()
-        return response.json()
-    except requests.RequestException:
-        return []
-
-def fetch_budget_info(user_id: Optional[str]) -> Optional[Dict]:
-    """Fetch budget information from the API"""
+    """
+    Fetch the available devices
+
+    Raises:
+        requests.RequestException: If the API can't be reached
+    """
+    response = requests.get(f"{API_BASE_URL}/devices", timeout=5)
+    response.raise_for_status()
+    return response.json() or []
+
+def request_budget_info(user_id: Optional[str]) -> Optional[Dict]:
+    """
+    Fetch budget information from the API. Nothing is printed, since this runs
+    in the menu's background refresh
+
+    Raises:
+        requests.RequestException: If the API can't be reached
+        ValueError: If the response isn't the expected budget data
+    """
     if not user_id:
         return None
-    try:
-        url = f"{API_BASE_URL}/get-budget/{user_id}"
-        response = requests.get(url, timeout=5)
-        response.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx)
+    url = f"{API_BASE_URL}/get-budget/{user_id}"
+    response = requests.get(url, timeout=5)
+    response.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx)
 
-        # Check if the response is valid JSON
-        try:
-            data = response.json()
-        except requests.exceptions.JSONDecodeError:
-            click.echo(f"Error: Invalid JSON response received from {url}", err=True)
-            return None
-
-        # Validate expected keys and types
-        if isinstance(data, dict) and \
-           'spent_cents' in data and isinstance(data['spent_cents'], int) and \
-           'earned_cents' in data and isinstance(data['earned_cents'], int):
-            return data
-        else:
-            click.echo(f"Error: Unexpected data format received from {url}. Expected 'spent_cents' and 'earned_cents' as integers.", err=True)
-            return None
-
-    except requests.exceptions.RequestException as e:
-        click.echo(f"Error fetching budget info: {e}", err=True)
-        return None
-    except Exception as e: # Catch any other unexpected errors
-        click.echo(f"An unexpected error occurred while fetching budget: {e}", err=True)
-        return None
+    # Check if the response is valid JSON
+    try:
+        data = response.json()
+    except requests.exceptions.JSONDecodeError:
+        raise ValueError(f"Invalid JSON response received from {url}")
+
+    # Validate expected keys and types
+    if isinstance(data, dict) and \
+       'spent_cents' in data and isinstance(data['spent_cents'], int) and \
+       'earned_cents' in data and isinstance(data['earned_cents'], int):
+        return data
+    raise ValueError(f"Unexpected data format received from {url}. Expected 'spent_cents' and 'earned_cents' as integers.")
+
+def fetch_job_list(user_id: Optional[str]) -> List[Dict]:
+    """Fetch the requester's jobs and file away any results we're waiting on"""
+    if not user_id:
+        return []
+    jobs = fetch_jobs(user_id)
+    memo.record_results(jobs)
+    tracing.record_results(jobs)
+    return jobs
 
 def get_script_files() -> List[str]:
     current_dir = os.getcwd()
@@ -98,32 +119,52 @@ def get_script_files() -> List[str]:
             files.append(file)
     return sorted(files)
 
-def count_file_lines(filepath: str) -> int:
-    try:
-        with open(filepath, 'r') as f:
-            return sum(1 for _ in f)
-    except Exception:
-        return 0
-
-def calculate_price(num_lines: int) -> float:
-    return num_lines / 100
-
-def create_job_flow(selected_resource: Dict):
+def get_bundle_dirs() -> List[str]:
+    """List the current directory and its subdirectories that have a bundle manifest"""
+    current_dir = os.getcwd()
+    dirs = []
+    if os.path.isfile(os.path.join(current_dir, MANIFEST_NAME)):
+        dirs.append('.')
+    for entry in os.listdir(current_dir):
+        if os.path.isfile(os.path.join(current_dir, entry, MANIFEST_NAME)):
+            dirs.append(entry)
+    return sorted(dirs)
+
+def describe_job_source(path: str):
+    """Print what would be submitted and return its price"""
+    if os.path.isdir(path):
+        manifest = load_manifest(path)
+        num_files = len(collect_files(path, manifest))
+        num_lines = count_bundle_lines(path, manifest)
+        click.echo(f"\nBundle: {path} ({num_files} files, entry {manifest['entry']})")
+    else:
+        num_lines = count_file_lines(path)
+        click.echo(f"\nScript: {path}")
+    price = calculate_price(num_lines)
+    click.echo(f"Lines of code: {num_lines}")
+    click.echo(f"Estimated price: ${price:.6f}")
+    return price
+
+def create_job_flow(selected_resource: Dict) -> bool:
+    """Pick a script or bundle and submit it to the resource. Returns True if a job was created"""
+    created = False
     click.clear()
     click.echo(f"\nCreating new job for resource: {selected_resource['url']}")
     
     script_files = get_script_files()
-    if not script_files:
-        click.echo(f"\nThere are no .py or .js scripts in this directory ({os.getcwd()})")
+    bundle_dirs = get_bundle_dirs()
+    if not script_files and not bundle_dirs:
+        click.echo(f"\nThere are no .py or .js scripts or {MANIFEST_NAME} bundles in this directory ({os.getcwd()})")
         click.pause()
-        return
+        return created
     
     click.echo("\nAvailable script files:")
     
+    choices = script_files + [(f"{d}/ (bundle)", d) for d in bundle_dirs]
     questions = [
         inquirer.List('script',
-                     message="Select a script file",
-                     choices=script_files,
+                     message="Select a script file or bundle",
+                     choices=choices,
                      carousel=True)
     ]
     
@@ -132,45 +173,29 @@ def create_job_flow(selected_resource: Dict):
         if not answers:
             click.echo("\nOperation cancelled")
             click.pause()
-            return
+            return created
             
         selected_file = answers['script']
         
-        num_lines = count_file_lines(selected_file)
-        price = calculate_price(num_lines)
-        
-        click.echo(f"\nScript: {selected_file}")
-        click.echo(f"Lines of code: {num_lines}")
-        click.echo(f"Estimated price: ${price:.6f}")
+        try:
+            describe_job_source(selected_file)
+        except BundleError as e:
+            click.echo(f"\nError: {e}")
+            click.pause()
+            return created
         
         if click.confirm("\nWould you like to create this job?"):
             try:
-                with open(selected_file, 'r') as f:
-                    code = f.read()
-                
-                lang = 'python' if selected_file.endswith('.py') else 'javascript'
-                
-                device_id = selected_resource['user_id']
-                
-                job_data = {
-                    'requester': get_user_id(),
-                    'device_id': device_id,
-                    'filename': selected_file,
-                    'lang': lang,
-                    'code': code,
-                    'cost_usd': price
-                }
+                build_started = time.time()
+                job_data = build_job(selected_file, selected_resource['user_id'])
                 
-                response = requests.post(
-                    f"{API_BASE_URL}/submit-job",
-                    json=job_data,
-                    timeout=5
-                )
-                
-                if response.status_code == 200:
+                if submit_job(job_data, build_started) is not None:
+                    created = True
                     click.echo("\nJob created successfully!")
                 else:
                     click.echo("\nError: Please try again later.")
+            except BundleError as e:
+                click.echo(f"\nError: {e}")
             except IOError:
                 click.echo("\nError: Could not read the selected file.")
         
@@ -179,16 +204,30 @@ def create_job_flow(selected_resource: Dict):
     except (KeyboardInterrupt, EOFError):
         click.echo("\nOperation cancelled")
         click.pause()
-
-def display_resources():
-    resources = fetch_resources()
+    return created
+
+def echo_freshness(menu_data: MenuData, name: str, snapshot: Optional[Dict]):
+    """Show how current the data on screen is, and refresh it in the background if stale"""
+    stale = menu_data.is_stale(snapshot)
+    if stale or (snapshot and snapshot['error']):
+        menu_data.refresh(name)
+    click.echo(click.style(f"({freshness(snapshot, stale)})", dim=True))
+
+def display_resources(menu_data: MenuData):
+    # Normally already fetched at startup; only wait if we opened the menu right away
+    snapshot = menu_data.get('resources', wait=5)
+    resources = snapshot['value'] if snapshot else None
     
     if not resources:
         click.echo("\nNo resources available.")
+        if snapshot and snapshot['error']:
+            echo_freshness(menu_data, 'resources', snapshot)
+        click.pause()
         return
         
     click.clear()
     click.echo("\nAvailable Resources:")
+    echo_freshness(menu_data, 'resources', snapshot)
     click.echo("-" * 80)
     
     choices = []
@@ -218,23 +257,30 @@ def display_resources():
     try:
         answers = inquirer.prompt(questions)
         if answers and answers['resource'] != "back":
-            create_job_flow(answers['resource'])
+            if create_job_flow(answers['resource']):
+                menu_data.refresh('jobs')
     except (KeyboardInterrupt, EOFError):
         pass
 
-def display_jobs():
-    user_id = get_user_id()
+def display_jobs(menu_data: MenuData):
+    snapshot = menu_data.get('jobs', wait=5)
     try:
-        response = requests.get(f"{API_BASE_URL}/jobs/{user_id}", timeout=5)
-        response.raise_for_status()
-        jobs = response.json()
+        if snapshot is None or snapshot['value'] is None:
+            error = snapshot['error'] if snapshot else "timed out"
+            click.echo(f"\nError fetching jobs: {error}", err=True)
+            menu_data.refresh('jobs')
+            click.pause()
+            return
+        jobs = snapshot['value']
 
         if not jobs:
             click.echo("\nNo jobs found.")
+            echo_freshness(menu_data, 'jobs', snapshot)
             click.pause()
             return
 
         click.echo("\nYour Jobs:")
+        echo_freshness(menu_data, 'jobs', snapshot)
         click.echo("-" * 80)
 
         choices = []
@@ -278,6 +324,13 @@ def display_jobs():
                 click.echo(stdout)
                 click.echo("\nStandard Error:")
                 click.echo(selected_job_data.get('stderr', 'No errors') or 'No errors')
+                for name in selected_job_data.get('full_output') or []:
+                    click.echo(f"\nFull {name} was truncated above; get it with: gmr output {selected_job_data['id']} --stream {name}")
+                if selected_job_data.get('artifacts'):
+                    click.echo(f"\nArtifacts: {', '.join(selected_job_data['artifacts'])}")
+                    click.echo(f"Download them with: gmr fetch {selected_job_data['id']}")
+                    if profiling.PROFILE_ARTIFACT in selected_job_data['artifacts']:
+                        click.echo(f"Show the profile with: gmr profile {selected_job_data['id']}")
                 click.echo("\nPress any key to go back...")
                 click.pause()
 
@@ -288,17 +341,21 @@ def display_jobs():
             click.echo(f"\nAn error occurred while displaying job details: {e}")
             click.pause()
 
-    except requests.exceptions.RequestException as e:
-        click.echo(f"\nError fetching jobs: {e}", err=True)
-        click.pause()
-    except Exception as e: # Catch any other unexpected errors during job fetching/processing
+    except Exception as e: # Catch any other unexpected errors during job processing
         click.echo(f"\nAn unexpected error occurred while fetching jobs: {e}", err=True)
         click.pause()
 
 def show_main_menu():
     monitor.start()
     user_id = get_user_id() # Get user_id once
-    budget_info = fetch_budget_info(user_id) # Fetch budget info once on startup
+    # Budget, devices and jobs are fetched concurrently in the background and kept
+    # fresh, so the menu draws from the latest snapshot without waiting on the API
+    menu_data = MenuData({
+        'budget': lambda: request_budget_info(user_id),
+        'resources': fetch_resources,
+        'jobs': lambda: fetch_job_list(user_id),
+    })
+    menu_data.start()
 
     try:
         while True:
@@ -306,6 +363,8 @@ def show_main_menu():
             click.echo("\n=== Give My Permission ===\n")
             click.echo("Share your device's power, run code remotely.\n")
 
+            budget_snapshot = menu_data.get('budget')
+            budget_info = budget_snapshot['value'] if budget_snapshot else None
             # Display Budget Info if available
             if budget_info:
                 try:
@@ -323,11 +382,22 @@ def show_main_menu():
                         earnings_dollars = (earned_cents - 1000) / 100.0 
                         click.echo(click.style(f"Balance: ${balance_dollars:.2f}", fg='green'))
                         click.echo(f"Earnings: ${earnings_dollars:.2f}")
+                        echo_freshness(menu_data, 'budget', budget_snapshot)
                         click.echo() # Add a blank line for spacing
                 except Exception as e:
                      # Catch potential calculation errors, though type checks should prevent most
                      click.echo(f"Error displaying budget: {e}", err=True)
                      # budget_info = None # Prevent repeated errors
+            elif user_id:
+                click.echo("Balance: ", nl=False)
+                echo_freshness(menu_data, 'budget', budget_snapshot)
+                click.echo()
+
+            jobs_snapshot = menu_data.get('jobs')
+            if jobs_snapshot and jobs_snapshot['value']:
+                finished = sum(1 for job in jobs_snapshot['value'] if job.get('status') == 'FINISHED')
+                click.echo(f"Your jobs: {len(jobs_snapshot['value']) - finished} in progress, {finished} finished ", nl=False)
+                echo_freshness(menu_data, 'jobs', jobs_snapshot)
 
             device_status = get_device_status()
             status_emoji = "🟢" if device_status else "🔴"
@@ -359,12 +429,12 @@ def show_main_menu():
                 if choice == "1":
                     monitor.set_status("BUSY")
                     click.clear()
-                    display_resources()
+                    display_resources(menu_data)
                     monitor.set_status("ACTIVE" if device_status else "INACTIVE")
                 elif choice == "2":
                     monitor.set_status("BUSY")
                     click.clear()
-                    display_jobs()
+                    display_jobs(menu_data)
                     monitor.set_status("ACTIVE" if device_status else "INACTIVE")
                 elif choice == "3":
                     new_status = not device_status
@@ -377,6 +447,7 @@ def show_main_menu():
                 break
                 
     finally:
+        menu_data.stop()
         monitor.stop()
 
 @click.group(invoke_without_command=True)
@@ -587,4 +658,230 @@ def main(ctx, hardreset, deletejob, use_ngrok):
 
 @main.command()
 def hello():
-    click.echo("Hello from give-my-resources!")
\ No newline at end of file
+    click.echo("Hello from give-my-resources!")
+
+@main.command()
+@click.option('--user-id', help='Store this user ID before starting (for unattended setup)')
+@click.option('--pid-file', type=click.Path(dir_okay=False), default=str(PID_FILE), show_default=True,
+              help='Where to write the agent pid')
+@click.option('--status-file', type=click.Path(dir_okay=False), default=str(STATUS_FILE), show_default=True,
+              help='Where to write the agent status JSON')
+@click.option('--drain-timeout', type=float, default=60, show_default=True,
+              help='Seconds to wait for a running job on SIGTERM before exiting')
+@click.option('--log-level', type=click.Choice(['DEBUG', 'INFO', 'WARNING', 'ERROR'], case_sensitive=False),
+              default='INFO', show_default=True)
+@click.option('--log-format', type=click.Choice(['json', 'text']), default='json', show_default=True)
+def agent(user_id, pid_file, status_file, drain_timeout, log_level, log_format):
+    """Run headless: heartbeat, job intake and execution as a long-lived service"""
+    setup_logging(log_level, log_format)
+    if user_id:
+        set_user_id(user_id)
+    exit_code = Agent(pid_file=pid_file, status_file=status_file, drain_timeout=drain_timeout).run()
+    raise SystemExit(exit_code)
+
+
+def echo_job_output(stdout: str, stderr: str):
+    click.echo("\nStandard Output:")
+    click.echo(stdout or 'No output')
+    click.echo("\nStandard Error:")
+    click.echo(stderr or 'No errors')
+
+@main.command()
+@click.argument('path', type=click.Path(exists=True))
+@click.option('--device', 'device_id', required=True, help='User ID of the device to run on')
+@click.option('-r', '--requirements', 'requirements_file', type=click.Path(exists=True, dir_okay=False),
+              help='requirements.txt to install on the device (Python jobs)')
+@click.option('--arg', 'args', multiple=True, help='Command-line argument passed to the script (repeatable)')
+@click.option('--artifact', 'artifacts', multiple=True,
+              help='Glob of a file the job writes that should be kept for `gmr fetch` (repeatable)')
+@click.option('--profile', 'profile_cpu', is_flag=True,
+              help='Run the job under cProfile and return the profile (Python jobs)')
+@click.option('--profile-memory', is_flag=True,
+              help='Also trace memory allocations with tracemalloc (implies --profile)')
+@click.option('--runtime', default='', help='Runtime version the job expects, e.g. python3.11; cached results from other runtimes are not reused')
+@click.option('--deterministic', is_flag=True,
+              help='Job output depends only on its code and inputs; reuse cached results of identical jobs')
+@click.option('--no-cache', is_flag=True, help='Always run remotely, even if a cached result exists')
+@click.option('--wait', is_flag=True, help='Wait for the job to finish and print its output')
+@click.option('--yes', is_flag=True, help='Submit without asking for confirmation')
+def submit(path, device_id, requirements_file, args, artifacts, profile_cpu, profile_memory,
+           runtime, deterministic, no_cache, wait, yes):
+    """Submit a script file, or a directory with a gmr.json manifest, as a job"""
+    user_id = get_user_id()
+    if not user_id:
+        raise click.ClickException("You need to sign up first; run `gmr` once.")
+    try:
+        describe_job_source(path)
+        if not yes and not click.confirm("\nWould you like to create this job?"):
+            return
+        build_started = time.time()
+        job_data = build_job(path, device_id, requirements_file)
+    except BundleError as e:
+        raise click.ClickException(str(e))
+    except IOError:
+        raise click.ClickException(f"Could not read {path}")
+    job_data['args'] = list(args)
+    if artifacts:
+        job_data['artifacts'] = job_data.get('artifacts', []) + list(artifacts)
+    if runtime:
+        job_data['runtime'] = runtime
+    if profile_cpu or profile_memory:
+        if job_data['lang'] != 'python':
+            raise click.ClickException("Profiling is only supported for Python jobs")
+        job_data['profile'] = [profiling.CPU] + ([profiling.MEMORY] if profile_memory else [])
+
+    cache_key = None
+    if deterministic:
+        job_data['deterministic'] = True
+        cache_key = memo.memo_key(job_data)
+        # A cached result has no profile, so profiling always runs the job
+        cached = None if no_cache or job_data.get('profile') else memo.lookup(cache_key, runtime)
+        if cached:
+            click.echo(f"Using cached result of identical job {cached['job_id']} (nothing submitted).")
+            echo_job_output(cached['stdout'], cached['stderr'])
+            return
+
+    result = submit_job(job_data, build_started)
+    if result is None:
+        raise click.ClickException("Job submission failed, please try again later.")
+    job_id = result.get('id') or result.get('job_id')
+    click.echo(f"Job created successfully!{f' ID: {job_id}' if job_id else ''}")
+    if cache_key and job_id:
+        memo.remember_pending(job_id, cache_key)
+
+    if wait:
+        if not job_id:
+            raise click.ClickException("The server did not return a job ID to wait on.")
+        click.echo("Waiting for the job to finish...")
+        job = wait_for_job(user_id, job_id)
+        if job is None:
+            raise click.ClickException("Timed out waiting for the job.")
+        echo_job_output(job.get('stdout') or job.get('stdoutt'), job.get('stderr'))
+        if profiling.PROFILE_ARTIFACT in (job.get('artifacts') or []):
+            click.echo(f"\nShow the profile with: gmr profile {job_id}")
+
+@main.command()
+@click.argument('job_id')
+def cancel(job_id):
+    """Cancel a queued or running job"""
+    if not get_user_id():
+        raise click.ClickException("You need to sign up first; run `gmr` once.")
+    if not cancel_job(job_id):
+        raise click.ClickException(f"Could not cancel job {job_id}; it may already be finished.")
+    click.echo(f"Cancellation of job {job_id} requested.")
+
+@main.command('config')
+@click.argument('key', required=False, type=click.Choice(sorted(SETTING_TYPES)))
+@click.argument('value', required=False)
+@click.option('--unset', is_flag=True, help='Remove the setting and use the default')
+def config_command(key, value, unset):
+    """Show or change agent settings"""
+    if key is None:
+        for name in sorted(SETTING_TYPES):
+            click.echo(f"{name} = {get_setting(name, '')}")
+        return
+    if unset:
+        set_setting(key, None)
+    elif value is not None:
+        try:
+            set_setting(key, SETTING_TYPES[key](value))
+        except ValueError:
+            raise click.BadParameter(f"expected {SETTING_TYPES[key].__name__}", param_hint='VALUE')
+    click.echo(f"{key} = {get_setting(key, '')}")
+
+
+@main.command()
+@click.argument('job_id')
+@click.option('--stream', type=click.Choice(['stdout', 'stderr']), default='stdout', show_default=True)
+def output(job_id, stream):
+    """Print the full output of a job whose inline output was truncated"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        try:
+            path, = fetch_artifacts(job_id, Path(temp_dir), [f"{OUTPUT_PREFIX}{stream}.log"])
+        except ArtifactError as e:
+            raise click.ClickException(str(e))
+        out = click.get_binary_stream('stdout')
+        with open(path, 'rb') as f:
+            shutil.copyfileobj(f, out)
+
+@main.command()
+@click.argument('job_id')
+@click.option('--dest', type=click.Path(file_okay=False), default='.', show_default=True,
+              help='Directory to download into')
+@click.option('--name', 'names', multiple=True, help='Only download this artifact (repeatable)')
+@click.option('--parallel', type=click.IntRange(1, 32), default=DOWNLOAD_WORKERS, show_default=True,
+              help='Concurrent ranged requests per file')
+def fetch(job_id, dest, names, parallel):
+    """Download the artifacts of a finished job"""
+    dest_dir = Path(dest) / f"job-{job_id}"
+    try:
+        paths = fetch_artifacts(job_id, dest_dir, list(names) or None, workers=parallel)
+    except ArtifactError as e:
+        raise click.ClickException(str(e))
+    for path in paths:
+        click.echo(f"Downloaded {path}")
+
+@main.command()
+@click.argument('job_id')
+def trace(job_id):
+    """Show where a job's time went: the critical path through its trace"""
+    if not any(e['name'] == 'result' for e in tracing.load_events(job_id)):
+        # Pick up the agent's spans if the result has arrived since we last looked
+        try:
+            tracing.record_results(fetch_jobs(get_user_id()))
+        except requests.RequestException:
+            pass
+    events = tracing.load_events(job_id)
+    if not events:
+        raise click.ClickException(f"No trace recorded for job {job_id}")
+
+    path = tracing.critical_path(events)
+    if not path:
+        raise click.ClickException(f"No spans recorded for job {job_id} yet")
+    total = (path[-1]['start'] + path[-1]['dur'] - path[0]['start']) or 1
+    click.echo(f"\nCritical path for job {job_id}:")
+    click.echo("-" * 80)
+    click.echo(f"{'offset':>10}  {'duration':>10}  {'share':>6}  {'where':<9}  stage")
+    for segment in path:
+        where = tracing.PROCESS_NAMES.get(segment['pid'], '')
+        click.echo(
+            f"{(segment['start'] - path[0]['start']) / 1000:>8.1f}ms  "
+            f"{segment['dur'] / 1000:>8.1f}ms  "
+            f"{segment['dur'] * 100 / total:>5.1f}%  "
+            f"{where:<9}  {segment['name']}"
+        )
+    click.echo("-" * 80)
+    click.echo(f"Total: {total / 1000:.1f}ms")
+    if not any(e['pid'] == tracing.AGENT for e in events):
+        click.echo("No agent spans yet; the job may still be running.")
+    click.echo(f"\nFull trace: {tracing.trace_path(job_id)} (open in chrome://tracing or ui.perfetto.dev)")
+
+@main.command('profile')
+@click.argument('job_id')
+@click.option('--top', 'top_n', type=click.IntRange(1), default=20, show_default=True,
+              help='Number of functions and allocation sites to show')
+@click.option('--sort', type=click.Choice(['tottime', 'cumtime', 'calls']), default='tottime', show_default=True,
+              help='Rank functions by own time, time including callees, or calls')
+def profile_command(job_id, top_n, sort):
+    """Show the hot functions and allocation sites of a job submitted with --profile"""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        try:
+            path, = fetch_artifacts(job_id, Path(temp_dir), [profiling.PROFILE_ARTIFACT])
+        except ArtifactError as e:
+            raise click.ClickException(str(e))
+        data = profiling.load_profile(path)
+
+    click.echo(f"\nTop {top_n} functions by {sort}:")
+    click.echo("-" * 80)
+    click.echo(f"{'calls':>10}  {'tottime':>9}  {'cumtime':>9}  function")
+    for row in profiling.top_functions(data, top_n, sort):
+        calls = str(row['calls']) if row['calls'] == row['primitive_calls'] \
+            else f"{row['calls']}/{row['primitive_calls']}"
+        click.echo(f"{calls:>10}  {row['tottime']:>8.3f}s  {row['cumtime']:>8.3f}s  {row['function']}")
+
+    if 'allocations' in data:
+        click.echo(f"\nTop {top_n} allocation sites (peak traced memory {data['memory_peak'] / 1024:.0f} KiB):")
+        click.echo("-" * 80)
+        click.echo(f"{'size':>12}  {'blocks':>8}  site")
+        for row in profiling.top_allocations(data, top_n):
+            click.echo(f"{row['size'] / 1024:>9.1f}KiB  {row['count']:>8}  {row['site']}")
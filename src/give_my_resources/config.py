@@ -3,6 +3,7 @@ Configuration management for give-my-resources
 """
 import json
 import os
+import threading
 from pathlib import Path
 
 CONFIG_DIR = Path.home() / '.give-my-resources'
@@ -11,10 +12,70 @@ CONFIG_FILE = CONFIG_DIR / 'config.json'
 # Default API Base URL (Production)
 API_BASE_URL = "https://vibe25-worker.pumpkin-executables.workers.dev/"
 
+def boolean(value) -> bool:
+    """Parse a boolean setting given on the command line"""
+    if isinstance(value, bool):
+        return value
+    if str(value).lower() in ('1', 'true', 'yes', 'on'):
+        return True
+    if str(value).lower() in ('0', 'false', 'no', 'off'):
+        return False
+    raise ValueError(value)
+
+# Agent tuning settings that can be changed with `gmr config`, with their types
+SETTING_TYPES = {
+    'wheelhouse': str,  # Local directory of wheels for job environments (offline installs)
+    'index_url': str,  # Package index mirror for job environments
+    'env_cache_max_mb': int,  # Size bound of the job environment cache
+    'memo_ttl_hours': float,  # How long cached results of deterministic jobs stay valid
+    'memo_max_mb': float,  # Size bound of the cached results
+    'governor_enabled': boolean,  # Throttle/pause jobs when the owner is using the device
+    'owner_cpu_throttle': float,  # Owner CPU % above which jobs run at low priority
+    'owner_cpu_pause': float,  # Owner CPU % above which jobs are stopped
+    'memory_pause': float,  # Memory % used by others above which jobs are stopped (by jobs: no new ones)
+    'input_idle_seconds': float,  # Input idle time before the owner counts as away (until then jobs run at low priority)
+    'max_jobs': int,  # Jobs run concurrently, each on its own cores
+    'cores_per_job': int,  # Physical cores (with their SMT siblings) pinned per job (default: split evenly)
+    'reserved_cores': int,  # Physical cores kept free for the agent and the owner
+    'output_memory_kb': int,  # Job output held in memory before spilling to disk
+    'output_head_kb': int,  # Start of a large output kept in the inline result
+    'output_tail_kb': int,  # End of a large output kept in the inline result
+    'outbox_batch_size': int,  # Job results delivered per request
+    'outbox_batch_kb': int,  # Size bound of a result delivery request (before compression)
+    'outbox_flush_seconds': float,  # Longest a result waits to be batched with others
+    'menu_refresh_seconds': float,  # How often the interactive menu refreshes budget, devices and jobs
+    'job_sync_seconds': float,  # First sync interval while jobs run (backs off to the heartbeat interval)
+}
+
+# The agent updates config from several threads; serialize read-modify-write cycles
+_config_lock = threading.RLock()
+
 def ensure_config_dir():
     """Ensure the config directory exists"""
     CONFIG_DIR.mkdir(parents=True, exist_ok=True)
 
+def write_atomic(path: Path, content: str):
+    """
+    Write a file so readers never see a partial version: write a temporary file
+    next to it, then rename it into place. The temporary name is unique to the
+    writing thread, so concurrent writers don't clobber each other's halves
+    """
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        with open(tmp_path, 'w') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def _save_config(config: dict):
+    """Write the config atomically so concurrent readers never see a partial file"""
+    write_atomic(CONFIG_FILE, json.dumps(config))
+
 def get_user_id():
     """Get the stored user ID if it exists"""
     if not CONFIG_FILE.exists():
@@ -29,12 +90,11 @@ def get_user_id():
 
 def set_user_id(user_id: str):
     """Store the user ID"""
-    ensure_config_dir()
-    config = get_config() or {}
-    config['user_id'] = user_id
-    
-    with open(CONFIG_FILE, 'w') as f:
-        json.dump(config, f)
+    with _config_lock:
+        ensure_config_dir()
+        config = get_config() or {}
+        config['user_id'] = user_id
+        _save_config(config)
 
 def get_config():
     """Get the full config if it exists"""
@@ -54,12 +114,11 @@ def get_refresh_token():
 
 def set_refresh_token(refresh_token: str):
     """Store the refresh token"""
-    ensure_config_dir()
-    config = get_config() or {}
-    config['refresh_token'] = refresh_token
-    
-    with open(CONFIG_FILE, 'w') as f:
-        json.dump(config, f)
+    with _config_lock:
+        ensure_config_dir()
+        config = get_config() or {}
+        config['refresh_token'] = refresh_token
+        _save_config(config)
 
 def get_device_status():
     """Get the device status (enabled/disabled)"""
@@ -68,12 +127,11 @@ def get_device_status():
 
 def set_device_status(enabled: bool):
     """Store the device status"""
-    ensure_config_dir()
-    config = get_config() or {}
-    config['device_enabled'] = enabled
-    
-    with open(CONFIG_FILE, 'w') as f:
-        json.dump(config, f)
+    with _config_lock:
+        ensure_config_dir()
+        config = get_config() or {}
+        config['device_enabled'] = enabled
+        _save_config(config)
 
 def get_current_job():
     """Get the stored current job if it exists"""
@@ -82,22 +140,20 @@ def get_current_job():
 
 def set_current_job(job_data: dict):
     """Store the current job data"""
-    ensure_config_dir()
-    config = get_config() or {}
-    config['current_job'] = job_data
-    
-    with open(CONFIG_FILE, 'w') as f:
-        json.dump(config, f)
+    with _config_lock:
+        ensure_config_dir()
+        config = get_config() or {}
+        config['current_job'] = job_data
+        _save_config(config)
 
 def clear_current_job():
     """Clear the current job data"""
-    ensure_config_dir()
-    config = get_config() or {}
-    if 'current_job' in config:
-        del config['current_job']
-    
-    with open(CONFIG_FILE, 'w') as f:
-        json.dump(config, f)
+    with _config_lock:
+        ensure_config_dir()
+        config = get_config() or {}
+        if 'current_job' in config:
+            del config['current_job']
+        _save_config(config)
 
 def get_ngrok_token():
     """Get the stored ngrok token if it exists"""
@@ -106,12 +162,11 @@ def get_ngrok_token():
 
 def set_ngrok_token(token: str):
     """Store the ngrok token"""
-    ensure_config_dir()
-    config = get_config() or {}
-    config['ngrok_token'] = token
-    
-    with open(CONFIG_FILE, 'w') as f:
-        json.dump(config, f)
+    with _config_lock:
+        ensure_config_dir()
+        config = get_config() or {}
+        config['ngrok_token'] = token
+        _save_config(config)
 
 def get_ngrok_id():
     """Get the stored ngrok ID if it exists"""
@@ -120,12 +175,11 @@ def get_ngrok_id():
 
 def set_ngrok_id(ngrok_id: str):
     """Store the ngrok ID"""
-    ensure_config_dir()
-    config = get_config() or {}
-    config['ngrok_id'] = ngrok_id
-    
-    with open(CONFIG_FILE, 'w') as f:
-        json.dump(config, f)
+    with _config_lock:
+        ensure_config_dir()
+        config = get_config() or {}
+        config['ngrok_id'] = ngrok_id
+        _save_config(config)
 
 def get_tunnel_url():
     """Get the stored ngrok tunnel URL if it exists"""
@@ -134,12 +188,42 @@ def get_tunnel_url():
 
 def set_tunnel_url(url: str):
     """Store the ngrok tunnel URL"""
-    ensure_config_dir()
-    config = get_config() or {}
-    config['tunnel_url'] = url
-    
-    with open(CONFIG_FILE, 'w') as f:
-        json.dump(config, f)
+    with _config_lock:
+        ensure_config_dir()
+        config = get_config() or {}
+        config['tunnel_url'] = url
+        _save_config(config)
+
+def get_setting(key: str, default=None):
+    """Get an agent tuning setting (see `gmr config`), or the default if unset"""
+    config = get_config()
+    settings = config.get('settings', {}) if config else {}
+    return settings.get(key, default)
+
+def set_setting(key: str, value):
+    """Store an agent tuning setting; None removes it"""
+    with _config_lock:
+        ensure_config_dir()
+        config = get_config() or {}
+        settings = config.setdefault('settings', {})
+        if value is None:
+            settings.pop(key, None)
+        else:
+            settings[key] = value
+        _save_config(config)
+
+def get_calibration():
+    """Get the cached performance calibration result if it exists"""
+    config = get_config()
+    return config.get('calibration') if config else None
+
+def set_calibration(result: dict):
+    """Store the performance calibration result"""
+    with _config_lock:
+        ensure_config_dir()
+        config = get_config() or {}
+        config['calibration'] = result
+        _save_config(config)
 
 def clear_user_data():
     """Clear all user data from config file"""
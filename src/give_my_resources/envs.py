@@ -0,0 +1,266 @@
+"""
+Cached per-requirements virtualenvs for Python jobs
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import psutil
+
+from .config import CONFIG_DIR, get_setting
+
+ENV_CACHE_DIR = CONFIG_DIR / 'envs'
+MARKER_NAME = '.gmr-env.json'
+
+# Defaults for the settings read via get_setting
+DEFAULT_ENV_CACHE_MAX_MB = 4096
+INSTALL_TIMEOUT = 600  # Seconds
+
+# How often a build checks whether the job it is for was cancelled
+CANCEL_CHECK_INTERVAL = 0.5
+
+logger = logging.getLogger(__name__)
+
+# Serializes builds of the same environment and protects the in-use counts
+_lock = threading.Lock()
+_building: Dict[str, threading.Lock] = {}
+_in_use: Dict[str, int] = {}
+
+class EnvError(Exception):
+    """Raised when a job environment cannot be built"""
+
+class EnvCancelled(EnvError):
+    """Raised when the job an environment was being built for is cancelled"""
+
+def _is_direct_reference(requirement: str) -> bool:
+    """A requirement naming a URL, VCS repo or local path rather than a package"""
+    spec = requirement.split(';', 1)[0]
+    return ('://' in spec or '@' in spec
+            or spec.startswith(('.', '/', '~', '\\', 'file:'))
+            or spec.endswith(('.whl', '.tar.gz', '.zip'))
+            or re.match(r'[A-Za-z]:[\\/]', spec) is not None)
+
+def normalize_requirements(requirements: List[str], allow_direct: bool = True) -> List[str]:
+    """
+    Drop comments/blank lines and sort, so equivalent lists share an environment
+
+    Args:
+        allow_direct: Whether URL and path requirements are allowed; they aren't when
+            the device installs only from its wheelhouse
+
+    Raises:
+        EnvError: For pip options (--index-url, -r, ...), which would override the
+            device's package source policy, and for disallowed direct references
+    """
+    cleaned = set()
+    for line in requirements:
+        line = line.split('#', 1)[0].strip()
+        if not line:
+            continue
+        if line.startswith('-'):
+            raise EnvError(f"pip options are not allowed in requirements: {line}")
+        if not allow_direct and _is_direct_reference(line):
+            raise EnvError(f"This device only installs packages from its wheelhouse: {line}")
+        cleaned.add(line)
+    return sorted(cleaned)
+
+def base_python() -> str:
+    """The interpreter environments are created from"""
+    if getattr(sys, 'frozen', False):
+        # In the PyInstaller build sys.executable is gmr itself
+        python = shutil.which('python3') or shutil.which('python')
+        if not python:
+            raise EnvError("No python3 interpreter found on PATH to build job environments")
+        return python
+    return sys.executable
+
+def env_key(requirements: List[str]) -> str:
+    """Hash of the normalized requirements plus the interpreter that builds the env"""
+    h = hashlib.sha256()
+    h.update(base_python().encode())
+    h.update(b"\0")
+    h.update("\n".join(normalize_requirements(requirements)).encode())
+    return h.hexdigest()[:32]
+
+def _env_python(env_dir: Path) -> Path:
+    if os.name == 'nt':
+        return env_dir / 'Scripts' / 'python.exe'
+    return env_dir / 'bin' / 'python'
+
+def _dir_size(path: Path) -> int:
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_size
+            except OSError:
+                pass
+    return total
+
+def _install_args() -> List[str]:
+    """pip source options: a local wheelhouse takes precedence over an index mirror"""
+    wheelhouse = get_setting('wheelhouse')
+    index_url = get_setting('index_url')
+    if wheelhouse:
+        return ['--no-index', '--find-links', str(wheelhouse)]
+    if index_url:
+        return ['--index-url', index_url]
+    return []
+
+def _run(command: List[str], timeout: float, cancel: Optional[threading.Event]):
+    """
+    Like subprocess.run(check=True, capture_output=True), but gives up as soon as
+    cancel is set, killing the command and anything it started (e.g. pip's build backends)
+    """
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            stdout, stderr = process.communicate(timeout=CANCEL_CHECK_INTERVAL)
+            break
+        except subprocess.TimeoutExpired:
+            cancelled = cancel is not None and cancel.is_set()
+            if not cancelled and time.monotonic() < deadline:
+                continue
+            try:
+                procs = psutil.Process(process.pid).children(recursive=True)
+            except psutil.Error:
+                procs = []
+            for proc in procs:
+                try:
+                    proc.kill()
+                except psutil.Error:
+                    pass
+            process.kill()
+            process.communicate()
+            if cancelled:
+                raise EnvCancelled("Job cancelled while its environment was being built")
+            raise subprocess.TimeoutExpired(command, timeout)
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, command, stdout, stderr)
+
+def _build(env_dir: Path, requirements: List[str], cancel: Optional[threading.Event] = None):
+    if env_dir.exists():
+        # Left over from an interrupted build
+        shutil.rmtree(env_dir, ignore_errors=True)
+    try:
+        _run([base_python(), '-m', 'venv', str(env_dir)], 120, cancel)
+        if requirements:
+            with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as f:
+                f.write("\n".join(requirements) + "\n")
+                req_file = f.name
+            try:
+                _run([str(_env_python(env_dir)), '-m', 'pip', 'install',
+                      '--no-input', '--disable-pip-version-check',
+                      *_install_args(), '-r', req_file],
+                     INSTALL_TIMEOUT, cancel)
+            finally:
+                os.remove(req_file)
+    except subprocess.CalledProcessError as e:
+        shutil.rmtree(env_dir, ignore_errors=True)
+        raise EnvError(f"Installing requirements failed:\n{(e.stderr or e.stdout or '').strip()[-2000:]}")
+    except (subprocess.TimeoutExpired, OSError) as e:
+        shutil.rmtree(env_dir, ignore_errors=True)
+        raise EnvError(f"Building environment failed: {e}")
+    except EnvCancelled:
+        shutil.rmtree(env_dir, ignore_errors=True)
+        raise
+
+    marker = {
+        'requirements': requirements,
+        'python': base_python(),
+        'created': int(time.time()),
+        'size': _dir_size(env_dir),
+    }
+    # Written last: an env without a marker is incomplete and gets rebuilt
+    with open(env_dir / MARKER_NAME, 'w') as f:
+        json.dump(marker, f)
+
+def _read_marker(env_dir: Path) -> Optional[Dict]:
+    try:
+        with open(env_dir / MARKER_NAME, 'r') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+
+def evict(max_mb: Optional[int] = None):
+    """Remove least recently used environments until the cache fits its size limit"""
+    if max_mb is None:
+        max_mb = int(get_setting('env_cache_max_mb', DEFAULT_ENV_CACHE_MAX_MB))
+    if not ENV_CACHE_DIR.exists():
+        return
+    envs = []
+    for env_dir in ENV_CACHE_DIR.iterdir():
+        marker = _read_marker(env_dir)
+        if marker is None:
+            continue
+        envs.append(((env_dir / MARKER_NAME).stat().st_mtime, marker.get('size', 0), env_dir))
+    total = sum(size for _, size, _ in envs)
+    limit = max_mb * 1024 * 1024
+    for _, size, env_dir in sorted(envs):
+        if total <= limit:
+            break
+        with _lock:
+            if _in_use.get(env_dir.name):
+                continue
+            logger.info("Evicting job environment", extra={'fields': {'env': env_dir.name, 'size': size}})
+            shutil.rmtree(env_dir, ignore_errors=True)
+        total -= size
+
+def _release(key: str):
+    with _lock:
+        if _in_use.get(key, 0) > 0:
+            _in_use[key] -= 1
+
+@contextmanager
+def job_env(requirements: List[str], cancel: Optional[threading.Event] = None):
+    """
+    Yield the python executable of an environment with these requirements installed,
+    building it on a cache miss. The environment can't be evicted while in use
+
+    Args:
+        cancel: Set to give up waiting for or building the environment
+
+    Raises:
+        EnvCancelled: If cancel was set first
+        EnvError: If the requirements aren't allowed or the environment can't be built
+    """
+    requirements = normalize_requirements(requirements, allow_direct=not get_setting('wheelhouse'))
+    key = env_key(requirements)
+    env_dir = ENV_CACHE_DIR / key
+
+    with _lock:
+        build_lock = _building.setdefault(key, threading.Lock())
+        _in_use[key] = _in_use.get(key, 0) + 1
+    try:
+        # Another job may be building the same environment; wait for it, but not past a cancel
+        while not build_lock.acquire(timeout=CANCEL_CHECK_INTERVAL):
+            if cancel is not None and cancel.is_set():
+                raise EnvCancelled("Job cancelled while waiting for its environment")
+        try:
+            if _read_marker(env_dir) is None:
+                ENV_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+                logger.info("Building job environment",
+                            extra={'fields': {'env': key, 'requirements': requirements}})
+                started = time.monotonic()
+                _build(env_dir, requirements, cancel)
+                logger.info("Job environment ready",
+                            extra={'fields': {'env': key, 'seconds': round(time.monotonic() - started, 1)}})
+                evict()
+            os.utime(env_dir / MARKER_NAME)  # Mark as recently used
+        finally:
+            build_lock.release()
+        yield str(_env_python(env_dir))
+    finally:
+        _release(key)
@@ -5,65 +5,274 @@ import os
 import sys
 import tempfile
 import subprocess
+import threading
+import time
+import psutil
 import requests
-from typing import Dict, Tuple
+from contextlib import ExitStack
+from typing import Callable, Dict, List, Optional, Tuple
 from pathlib import Path
 from .config import API_BASE_URL # Import API URL config
+from .bundle import BundleError, fetch_bundle, extract_bundle
+from .envs import EnvCancelled, EnvError, job_env
+from .output import OUTPUT_SPOOL_DIR, OutputCapture
+from .artifacts import ARTIFACT_SPOOL_DIR, collect_artifacts
+from .tracing import AGENT, JobTrace
+from .affinity import spawn_affinity
+from .profiling import PROFILE_ARTIFACT, compress_profile, profile_command
 
-def execute_code(job_data: Dict) -> Tuple[str, str]:
+# Seconds a job may run (not counting time it was stopped by the governor, up to MAX_STOPPED_SECONDS)
+EXECUTION_TIMEOUT = 30
+
+# Longest a job may spend stopped by the governor before it is given up on, so a
+# device that stays busy doesn't hold the job's slot forever
+MAX_STOPPED_SECONDS = 600
+
+# How often the waiting loop checks on the job
+WAIT_INTERVAL = 0.5
+
+# Seconds a profiled job gets after SIGTERM to write its profile before it is killed
+PROFILE_GRACE_SECONDS = 10
+
+# Appended to stderr when a job is stopped at the requester's request
+CANCELLED_MESSAGE = "\nJob cancelled by the requester"
+
+def prepare_sandbox(job_data: Dict, sandbox: Path) -> Path:
+    """
+    Materialize the job's code in the sandbox and return the path to run
+    
+    Single-file jobs carry their code inline; bundle jobs reference an archive by hash
+    which is fetched (or taken from the local cache) and unpacked.
+    """
+    if job_data.get('bundle'):
+        extract_bundle(fetch_bundle(job_data['bundle']), sandbox)
+        entry = (sandbox / job_data['entry']).resolve()
+        if sandbox.resolve() not in entry.parents or not entry.is_file():
+            raise BundleError(f"Bundle entry not found: {job_data['entry']}")
+        return entry
+    
+    file_path = sandbox / job_data['filename']
+    with open(file_path, 'w') as f:
+        f.write(job_data['code'])
+    return file_path
+
+def _is_stopped(pid: int) -> bool:
+    try:
+        return psutil.Process(pid).status() == psutil.STATUS_STOPPED
+    except psutil.Error:
+        return False
+
+def _process_tree(pid: int) -> List[psutil.Process]:
+    try:
+        parent = psutil.Process(pid)
+        return [parent] + parent.children(recursive=True)
+    except psutil.Error:
+        return []
+
+def _kill(procs: List[psutil.Process]):
+    for proc in procs:
+        try:
+            proc.kill()  # SIGKILL also ends processes stopped by the governor
+        except psutil.Error:
+            pass
+
+def kill_process_tree(pid: int):
+    """Kill a process and everything it started. The caller reaps the process itself"""
+    _kill(_process_tree(pid))
+
+def stop_process_tree(process: subprocess.Popen, grace: float = 0):
+    """
+    End a job's process tree and reap it. With a grace period the job first gets
+    SIGTERM, so e.g. the profiler can write what it has, and is killed only if it
+    hasn't exited in time
+    """
+    # Taken up front: once the job exits, its children are no longer found under it
+    procs = _process_tree(process.pid)
+    if grace and procs and os.name == 'posix':
+        try:
+            procs[0].resume()  # A process stopped by the governor doesn't act on SIGTERM
+            procs[0].terminate()
+            process.wait(timeout=grace)
+        except (psutil.Error, subprocess.TimeoutExpired):
+            pass
+    _kill(procs)
+    process.wait()
+
+# Interpreter path -> runtime version, e.g. python3.11.7; interpreters don't change under us
+_runtime_versions: Dict[str, Optional[str]] = {}
+
+def runtime_version(interpreter: str, lang: str) -> Optional[str]:
+    """
+    The version of the interpreter a job actually ran on, e.g. python3.11.7 or
+    node20.11.1, in the form requesters pass to --runtime. None if it can't be run
+    """
+    if interpreter not in _runtime_versions:
+        if interpreter == sys.executable:
+            version = "python%d.%d.%d" % sys.version_info[:3]
+        else:
+            if lang == 'python':
+                command = [interpreter, '-c', 'import sys; print("%d.%d.%d" % sys.version_info[:3])']
+            else:
+                command = [interpreter, '--version']
+            try:
+                out = subprocess.run(command, capture_output=True, text=True, timeout=10).stdout.strip()
+            except (OSError, subprocess.SubprocessError):
+                out = ''
+            version = f"{'python' if lang == 'python' else 'node'}{out.lstrip('v')}" if out else None
+        _runtime_versions[interpreter] = version
+    return _runtime_versions[interpreter]
+
+def execute_code(job_data: Dict,
+                 on_spawn: Optional[Callable[[subprocess.Popen], None]] = None,
+                 trace: Optional[JobTrace] = None,
+                 cancel: Optional[threading.Event] = None,
+                 cpus: Optional[List[int]] = None) -> Tuple[str, str, Dict]:
     """
     Safely execute the provided code in a temporary file and return stdout/stderr
     
+    Output is captured with a memory ceiling: large streams spill to a spool file
+    outside the sandbox and the returned text keeps only their head and tail.
+    
     Args:
-        job_data: Dictionary containing job information including code, filename, and language
+        job_data: Dictionary containing job information including code (or bundle and entry),
+            filename, and language
+        on_spawn: Called with the process once it has started, e.g. so the governor can manage it
+        trace: Where to record the write/env/spawn/run/collect spans
+        cancel: Set to stop the job; its process tree is killed within WAIT_INTERVAL
+        cpus: Logical CPUs the job is pinned to from the start, where the platform allows
         
     Returns:
-        Tuple of (stdout, stderr) from the execution
+        Tuple of (stdout, stderr, output info) from the execution. The info has byte counts,
+        truncation flags, the 'runtime_version' the job ran on and, under 'output_files',
+        the full output of truncated streams;
+        declared artifacts, and the profile of a profiled job, are under 'artifact_files'.
+        A cancelled job has 'cancelled' set and keeps no files but its profile
     """
+    info: Dict = {'output_files': {}}
+    trace = trace or JobTrace(job_data['id'], AGENT)
+    cancel = cancel or threading.Event()
     # Create a temporary directory that will be automatically cleaned up
-    with tempfile.TemporaryDirectory() as temp_dir:
-        # Create the temporary file with the correct extension
-        file_path = Path(temp_dir) / job_data['filename']
-        
+    with tempfile.TemporaryDirectory() as temp_dir, ExitStack() as stack:
         try:
-            # Write the code to the temporary file
-            with open(file_path, 'w') as f:
-                f.write(job_data['code'])
+            # Write the code (or unpack the bundle) into the sandbox
+            with trace.span('write'):
+                file_path = prepare_sandbox(job_data, Path(temp_dir))
             
             # Execute the code based on the language
             if job_data['lang'] == 'python':
-                # Use sys.executable to ensure we use the correct Python interpreter
-                process = subprocess.Popen(
-                    [sys.executable, str(file_path)],
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    text=True
-                )
+                # Use sys.executable to ensure we use the correct Python interpreter,
+                # or a cached environment when the job declares requirements
+                python = sys.executable
+                if job_data.get('requirements'):
+                    try:
+                        with trace.span('env'):
+                            python = stack.enter_context(job_env(job_data['requirements'], cancel))
+                    except EnvCancelled:
+                        info['cancelled'] = True
+                        return "", CANCELLED_MESSAGE.lstrip(), info
+                    except EnvError as e:
+                        return "", f"Error preparing environment: {e}", info
+                if job_data.get('profile'):
+                    profile_path = OUTPUT_SPOOL_DIR / str(job_data['id']) / 'profile.json'
+                    profile_path.parent.mkdir(parents=True, exist_ok=True)
+                    command = profile_command(python, file_path, profile_path, job_data['profile'])
+                else:
+                    command = [python, str(file_path)]
             elif job_data['lang'] == 'javascript':
                 # Assuming 'node' is available in the PATH
+                command = ['node', str(file_path)]
+            else:
+                return "", f"Unsupported language: {job_data['lang']}", info
+            info['runtime_version'] = runtime_version(command[0], job_data['lang'])
+            
+            if cancel.is_set():
+                # Cancelled while the sandbox or environment was being prepared
+                info['cancelled'] = True
+                return "", CANCELLED_MESSAGE.lstrip(), info
+            
+            with trace.span('spawn'), spawn_affinity(cpus or []):
                 process = subprocess.Popen(
-                    ['node', str(file_path)],
+                    [*command, *job_data.get('args', [])],
                     stdout=subprocess.PIPE,
                     stderr=subprocess.PIPE,
-                    text=True
+                    cwd=temp_dir
                 )
-            else:
-                return "", f"Unsupported language: {job_data['lang']}"
+                
+                if on_spawn:
+                    on_spawn(process)
+            spawned = time.time()
             
-            # Wait for the process to complete with a timeout
-            try:
-                stdout, stderr = process.communicate(timeout=30)  # 30 second timeout
-            except subprocess.TimeoutExpired:
-                process.kill()
-                stdout, stderr = process.communicate()
-                stderr += "\nExecution timed out after 30 seconds"
+            spool_dir = OUTPUT_SPOOL_DIR / str(job_data['id'])
+            captures = {
+                name: OutputCapture(name, spool_dir / f"{name}.log")
+                for name in ('stdout', 'stderr')
+            }
+            captures['stdout'].pump(process.stdout)
+            captures['stderr'].pump(process.stderr)
+            
+            # Wait for the process to complete with a timeout; time spent stopped
+            # by the governor doesn't count against it
+            deadline = time.monotonic() + EXECUTION_TIMEOUT
+            # A profile is most wanted for jobs that run too long, so give the profiler time to write it
+            grace = PROFILE_GRACE_SECONDS if job_data.get('profile') else 0
+            stopped_for = 0.0
+            while True:
+                try:
+                    process.wait(timeout=WAIT_INTERVAL)
+                    break
+                except subprocess.TimeoutExpired:
+                    if cancel.is_set():
+                        stop_process_tree(process, grace)
+                        info['cancelled'] = True
+                        captures['stderr'].append(CANCELLED_MESSAGE)
+                        break
+                    if _is_stopped(process.pid):
+                        stopped_for += WAIT_INTERVAL
+                        if stopped_for > MAX_STOPPED_SECONDS:
+                            stop_process_tree(process, grace)
+                            captures['stderr'].append(
+                                f"\nJob stopped for over {MAX_STOPPED_SECONDS} seconds while the device was busy")
+                            break
+                        deadline += WAIT_INTERVAL
+                    if time.monotonic() > deadline:
+                        stop_process_tree(process, grace)
+                        captures['stderr'].append(f"\nExecution timed out after {EXECUTION_TIMEOUT} seconds")
+                        break
+            trace.add('run', spawned, time.time(), exit_code=process.returncode)
+            
+            with trace.span('collect'):
+                # Files the job declared as artifacts must leave the sandbox before it's deleted
+                if job_data.get('artifacts') and not info.get('cancelled'):
+                    info['artifact_files'] = collect_artifacts(
+                        job_data['artifacts'], Path(temp_dir), ARTIFACT_SPOOL_DIR / str(job_data['id']) / 'files'
+                    )
+                
+                for name, capture in captures.items():
+                    full_output = capture.close()
+                    info[f'{name}_bytes'] = capture.total_bytes
+                    info[f'{name}_truncated'] = capture.truncated
+                    if full_output and not info.get('cancelled'):
+                        info['output_files'][name] = full_output
                 
-            return stdout, stderr
+                if job_data.get('profile') and job_data['lang'] == 'python' and profile_path.exists():
+                    info.setdefault('artifact_files', {})[PROFILE_ARTIFACT] = compress_profile(profile_path)
+                
+            return captures['stdout'].inline(), captures['stderr'].inline(), info
             
         except Exception as e:
-            return "", f"Error executing code: {str(e)}"
+            return "", f"Error executing code: {str(e)}", info
+
+def result_payload(job_id: str, stdout: str, stderr: str, extra: Optional[Dict] = None) -> Dict:
+    """The body that reports a job's result to the API"""
+    return {
+        **(extra or {}),
+        'job_id': job_id,
+        'stdout': stdout,
+        'stderr': stderr
+    }
 
-def update_job_status(job_id: str, stdout: str, stderr: str) -> bool:
+def update_job_status(job_id: str, stdout: str, stderr: str, extra: Optional[Dict] = None,
+                      session: Optional[requests.Session] = None) -> bool:
     """
     Send job execution results back to the API
     
@@ -71,20 +280,18 @@ def update_job_status(job_id: str, stdout: str, stderr: str) -> bool:
         job_id: The ID of the job that was executed
         stdout: Standard output from the execution
         stderr: Standard error from the execution
+        extra: Additional result fields, e.g. output sizes and truncation flags
+        session: Session to reuse the connection of, if any
         
     Returns:
         bool: True if the update was successful, False otherwise
     """
     try:
-        response = requests.post(
+        response = (session or requests).post(
             f"{API_BASE_URL}/update-job", # Use configured API URL
-            json={
-                'job_id': job_id,
-                'stdout': stdout,
-                'stderr': stderr
-            },
+            json=result_payload(job_id, stdout, stderr, extra),
             timeout=5
         )
         return response.status_code == 200
     except requests.RequestException:
-        return False
\ No newline at end of file
+        return False
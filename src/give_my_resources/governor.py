@@ -0,0 +1,255 @@
+"""
+Idle-aware execution governor: keeps jobs out of the device owner's way
+"""
+import ctypes
+import glob
+import logging
+import os
+import platform
+import re
+import shutil
+import subprocess
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Set
+
+import psutil
+
+from .config import get_setting
+
+# Governor states, from least to most restrictive
+RUN = "RUN"              # Host is free: accept jobs (at low priority while the owner is at the keyboard)
+THROTTLED = "THROTTLED"  # Owner is loading the CPU: no new jobs, running ones at low priority
+PAUSED = "PAUSED"        # Owner needs the machine: running jobs are stopped (SIGSTOP)
+
+# Defaults for the settings read via get_setting
+DEFAULT_OWNER_CPU_THROTTLE = 30.0  # Owner CPU % above which jobs are throttled
+DEFAULT_OWNER_CPU_PAUSE = 75.0     # Owner CPU % above which jobs are paused
+DEFAULT_MEMORY_PAUSE = 90.0        # Memory % used by others above which jobs are paused
+DEFAULT_INPUT_IDLE_SECONDS = 300   # Keyboard/mouse idle time before the owner counts as away
+
+# Seconds between governor checks
+GOVERNOR_INTERVAL = 2
+
+# Niceness applied to throttled jobs
+LOW_PRIORITY_NICE = 15
+
+logger = logging.getLogger(__name__)
+
+def _own_terminals() -> Set[str]:
+    """Terminals of this process and its parents, e.g. the one the gmr menu runs in"""
+    terminals = set()
+    try:
+        proc = psutil.Process()
+        for p in [proc] + proc.parents():
+            terminal = p.terminal()
+            if terminal:
+                terminals.add(os.path.realpath(terminal))
+    except (psutil.Error, AttributeError):
+        pass
+    return terminals
+
+def input_idle_seconds() -> Optional[float]:
+    """Seconds since the last keyboard/mouse/terminal input, or None if unknown"""
+    system = platform.system()
+    try:
+        if system == "Windows":
+            class LASTINPUTINFO(ctypes.Structure):
+                _fields_ = [("cbSize", ctypes.c_uint), ("dwTime", ctypes.c_uint)]
+            info = LASTINPUTINFO()
+            info.cbSize = ctypes.sizeof(info)
+            if ctypes.windll.user32.GetLastInputInfo(ctypes.byref(info)):
+                return (ctypes.windll.kernel32.GetTickCount() - info.dwTime) / 1000.0
+            return None
+        if system == "Darwin":
+            out = subprocess.run(['ioreg', '-c', 'IOHIDSystem'], capture_output=True, text=True, timeout=2).stdout
+            match = re.search(r'"HIDIdleTime" = (\d+)', out)
+            return int(match.group(1)) / 1e9 if match else None
+        if os.environ.get('DISPLAY') and shutil.which('xprintidle'):
+            out = subprocess.run(['xprintidle'], capture_output=True, text=True, timeout=2).stdout
+            return int(out.strip()) / 1000.0
+        # Like `w`: a terminal's access time is updated on input. Our own terminal
+        # doesn't count, or using the gmr menu would look like the owner being active
+        own = _own_terminals()
+        ttys = [t for t in glob.glob('/dev/pts/[0-9]*') + glob.glob('/dev/tty[0-9]*')
+                if os.path.realpath(t) not in own]
+        atimes = []
+        for tty in ttys:
+            try:
+                atimes.append(os.stat(tty).st_atime)
+            except OSError:
+                pass
+        return time.time() - max(atimes) if atimes else None
+    except (OSError, ValueError, AttributeError, subprocess.SubprocessError):
+        return None
+
+def _process_tree(pid: int) -> List[psutil.Process]:
+    try:
+        parent = psutil.Process(pid)
+        return [parent] + parent.children(recursive=True)
+    except psutil.Error:
+        return []
+
+class ExecutionGovernor:
+    """Watches owner load and input, and pauses intake, renices or stops running jobs"""
+
+    def __init__(self, job_pids: Callable[[], List[int]]):
+        self.job_pids = job_pids
+        self.state = RUN
+        self.owner_cpu = 0.0
+        self.memory_percent = 0.0
+        self.owner_memory = 0.0
+        self.idle_seconds: Optional[float] = None
+        self.owner_present = False
+        self.running = False
+        self.thread: Optional[threading.Thread] = None
+        self._stop_event = threading.Event()
+        # Reused so psutil can compute CPU deltas between checks
+        self._procs: Dict[int, psutil.Process] = {}
+        self._agent = psutil.Process()
+        self._lock = threading.Lock()
+
+    @property
+    def intake_paused(self) -> bool:
+        return self.state != RUN
+
+    def free_capacity(self) -> float:
+        """Cores the owner isn't using, i.e. what jobs can actually get"""
+        if self.state == PAUSED:
+            return 0.0
+        cores = psutil.cpu_count(logical=True) or 1
+        return round(max(0.0, cores * (100.0 - self.owner_cpu) / 100.0), 1)
+
+    def _job_processes(self) -> List[psutil.Process]:
+        procs = []
+        for pid in self.job_pids():
+            for proc in _process_tree(pid):
+                procs.append(self._procs.setdefault(proc.pid, proc))
+        live = {p.pid for p in procs}
+        self._procs = {pid: p for pid, p in self._procs.items() if pid in live}
+        return procs
+
+    def sample(self) -> List[psutil.Process]:
+        """
+        Measure owner CPU and memory (totals minus job usage) and input idleness.
+        The agent's own CPU (e.g. a calibration run) doesn't count as the owner's either
+        """
+        procs = self._job_processes()
+        cores = psutil.cpu_count(logical=True) or 1
+        total = psutil.cpu_percent(interval=None)
+        try:
+            job_cpu = self._agent.cpu_percent(interval=None)
+        except psutil.Error:
+            job_cpu = 0.0
+        job_rss = 0
+        for proc in procs:
+            try:
+                job_cpu += proc.cpu_percent(interval=None)
+                job_rss += proc.memory_info().rss
+            except psutil.Error:
+                pass
+        self.owner_cpu = max(0.0, total - job_cpu / cores)
+        vm = psutil.virtual_memory()
+        self.memory_percent = vm.percent
+        self.owner_memory = max(0.0, vm.percent - job_rss * 100.0 / vm.total)
+        self.idle_seconds = input_idle_seconds()
+        return procs
+
+    def decide(self) -> str:
+        """
+        Pick a state from the latest sample and the configured thresholds. Only CPU
+        and memory pressure stop intake; recent input (which may just be an SSH
+        session) only lowers the priority of running jobs, via owner_present
+        """
+        if not get_setting('governor_enabled', True):
+            self.owner_present = False
+            return RUN
+        idle_threshold = float(get_setting('input_idle_seconds', DEFAULT_INPUT_IDLE_SECONDS))
+        self.owner_present = self.idle_seconds is not None and self.idle_seconds < idle_threshold
+        memory_pause = float(get_setting('memory_pause', DEFAULT_MEMORY_PAUSE))
+        if (self.owner_cpu > float(get_setting('owner_cpu_pause', DEFAULT_OWNER_CPU_PAUSE))
+                or self.owner_memory > memory_pause):
+            return PAUSED
+        # Memory pressure from the jobs themselves: stopping them wouldn't free any,
+        # so they keep running but no more are taken on
+        if (self.owner_cpu > float(get_setting('owner_cpu_throttle', DEFAULT_OWNER_CPU_THROTTLE))
+                or self.memory_percent > memory_pause):
+            return THROTTLED
+        return RUN
+
+    def apply(self, state: str, procs: List[psutil.Process]):
+        """Bring running jobs in line with the state"""
+        for proc in procs:
+            try:
+                if state == PAUSED:
+                    if proc.status() != psutil.STATUS_STOPPED:
+                        proc.suspend()
+                    continue
+                if proc.status() == psutil.STATUS_STOPPED:
+                    proc.resume()
+                if state == THROTTLED or self.owner_present:
+                    if proc.nice() < LOW_PRIORITY_NICE:
+                        proc.nice(LOW_PRIORITY_NICE)
+                    if hasattr(proc, 'ionice') and hasattr(psutil, 'IOPRIO_CLASS_IDLE'):
+                        proc.ionice(psutil.IOPRIO_CLASS_IDLE)
+                else:
+                    # Raising priority back needs privileges; best effort
+                    if proc.nice() != 0:
+                        proc.nice(0)
+                    if hasattr(proc, 'ionice') and hasattr(psutil, 'IOPRIO_CLASS_BE'):
+                        proc.ionice(psutil.IOPRIO_CLASS_BE)
+            except (psutil.Error, OSError):
+                pass
+
+    def check(self):
+        """One governor tick: sample, decide, apply"""
+        with self._lock:
+            self._check()
+
+    def _check(self):
+        procs = self.sample()
+        state = self.decide()
+        if state != self.state:
+            logger.info("Governor state changed", extra={'fields': {
+                'from': self.state, 'to': state,
+                'owner_cpu': round(self.owner_cpu, 1),
+                'memory_percent': self.memory_percent,
+                'owner_memory': round(self.owner_memory, 1),
+                'input_idle': self.idle_seconds,
+            }})
+            self.state = state
+        self.apply(state, procs)
+
+    def enforce(self):
+        """Apply the current state to jobs now, e.g. right after one is spawned"""
+        with self._lock:
+            self.apply(self.state, self._job_processes())
+
+    def resume_all(self):
+        """Make sure nothing is left stopped, e.g. when shutting down"""
+        with self._lock:
+            self.owner_present = False
+            self.apply(RUN, self._job_processes())
+
+    def loop(self):
+        while self.running:
+            try:
+                self.check()
+            except Exception as e:
+                logger.warning("Governor check failed: %s", e)
+            self._stop_event.wait(GOVERNOR_INTERVAL)
+
+    def start(self):
+        if not self.running:
+            self.running = True
+            self._stop_event.clear()
+            self.thread = threading.Thread(target=self.loop, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self._stop_event.set()
+        if self.thread:
+            self.thread.join(timeout=1)
+            self.thread = None
+        self.resume_all()
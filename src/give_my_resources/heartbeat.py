@@ -1,45 +1,106 @@
 """
 Heartbeat monitoring for give-my-resources
 """
+import logging
 import random
 import psutil
 import requests
+import shutil
+import subprocess
 import threading
 import time
-from typing import Optional, Dict
+from typing import Optional, Dict, List, Tuple
 from .config import (
     get_user_id, get_device_status, 
     get_current_job, set_current_job, clear_current_job,
-    get_tunnel_url,
+    get_tunnel_url, get_calibration, get_setting,
     API_BASE_URL # Import API URL config
 )
-from .executor import execute_code, update_job_status
+from .executor import PROFILE_GRACE_SECONDS, WAIT_INTERVAL, execute_code, kill_process_tree, result_payload
+from .artifacts import OUTPUT_PREFIX, ArtifactUpload, resume_pending_uploads
+from .output import OUTPUT_SPOOL_DIR
+from .calibration import calibrate_if_stale
+from .governor import ExecutionGovernor
+from .affinity import CoreAllocator
+from .tracing import AGENT, JobTrace
+from .outbox import ResultOutbox
 
 # Define the local port ngrok will forward to
 LOCAL_PORT = 9000
 
+# Seconds between heartbeat/job-check ticks
+HEARTBEAT_INTERVAL = 20
+
+# Defaults for the settings read via get_setting
+DEFAULT_JOB_SYNC_SECONDS = 2  # First sync interval after a job starts, so a cancellation reaches it quickly
+
+# Only recalibrate when the host is this quiet, so scores reflect the hardware
+CALIBRATION_IDLE_LOAD = 25.0
+
+# Seconds before asking a server without /sync again (it may have been upgraded)
+SYNC_RETRY_INTERVAL = 600
+
+# Status codes meaning the server predates the combined /sync endpoint
+SYNC_UNSUPPORTED = (404, 405, 501)
+
+# Seconds to spend delivering queued results when stopping; the rest wait on disk
+OUTBOX_DRAIN_TIMEOUT = 10
+
+logger = logging.getLogger(__name__)
+
 class HeartbeatMonitor:
     def __init__(self):
         # Initialize status from config
         self.status = "ACTIVE" if get_device_status() else "INACTIVE"
         self.running = False
+        # Set once stop() or drain() is called so no new jobs are accepted
+        self.draining = False
         self.thread: Optional[threading.Thread] = None
-        # Initialize current_job from config
-        self.current_job: Optional[Dict] = get_current_job()
-        # Add execution thread
-        self.execution_thread: Optional[threading.Thread] = None
+        # Wakes the loop early, when stopping or when a cancelled job freed its slot,
+        # instead of sleeping out the interval
+        self._wake_event = threading.Event()
+        # Most recently started job, shown by the menu and persisted in config
+        self.current_job: Optional[Dict] = None
+        # Running jobs, their execution threads and processes, by job ID
+        self.jobs: Dict[str, Dict] = {}
+        self.job_threads: Dict[str, threading.Thread] = {}
+        self.job_processes: Dict[str, subprocess.Popen] = {}
+        self.cancel_events: Dict[str, threading.Event] = {}
+        self._jobs_lock = threading.Lock()
+        # Assigned jobs we couldn't take, reported on the next sync so they're reassigned
+        self.rejected_jobs: List[str] = []
+        # One connection to the API, reused by every request the agent makes
+        self.session = requests.Session()
+        # Finished jobs' results, delivered in batches until the server acknowledges them
+        self.outbox = ResultOutbox(self.session, on_acknowledged=self.results_delivered)
+        # When to try /sync again after the server turned out not to support it
+        self._legacy_until = 0.0
+        self.allocator = CoreAllocator()
+        self.governor = ExecutionGovernor(self.job_pids)
+    
+    def job_pids(self):
+        """PIDs of running job processes"""
+        with self._jobs_lock:
+            processes = list(self.job_processes.values())
+        return [p.pid for p in processes if p.poll() is None]
         
     def get_metrics(self):
         """Collect system metrics"""
         vm = psutil.virtual_memory()
-        # Update status based on both device status and current job
-        if self.current_job:
-            self.status = "BUSY"  # If we have a job, we're busy regardless of device status
+        # Update status based on both device status and running jobs
+        free_slots = self.allocator.free_slots()
+        if free_slots <= 0:
+            self.status = "BUSY"  # All job slots are taken, regardless of device status
+        elif self.draining:
+            self.status = "INACTIVE"  # Shutting down, don't advertise for new jobs
+        elif self.governor.intake_paused and get_device_status():
+            self.status = "BUSY"  # The owner is using the device
         else:
             self.status = "ACTIVE" if get_device_status() else "INACTIVE"
             
         # Get the public tunnel URL from config, fallback to local URL if not set yet
         tunnel_url = get_tunnel_url() or f"http://localhost:{LOCAL_PORT}"
+        calibration = get_calibration() or {}
             
         return {
             "user_id": get_user_id() or "",  # Ensure not None
@@ -49,41 +110,241 @@ class HeartbeatMonitor:
             "ram_total": int(vm.total / (1024 * 1024)),  # Convert to MB
             "ram_used": int(vm.used / (1024 * 1024)),  # Convert to MB
             "disk_free": int(psutil.disk_usage('/').free / (1024 * 1024)),  # Convert to MB
+            "perf_single_core": calibration.get("single_core"),  # SHA-256 MB/s on one core
+            "perf_multi_core": calibration.get("multi_core"),  # SHA-256 MB/s on all cores
+            "perf_scaling": calibration.get("scaling"),  # multi_core / single_core
+            "perf_memory_bandwidth": calibration.get("memory_bandwidth"),  # MB/s
+            "perf_disk_write": calibration.get("disk_write"),  # MB/s
+            "perf_measured_at": calibration.get("measured_at"),  # Unix timestamp
+            "free_capacity": self.governor.free_capacity(),  # Cores not used by the owner
+            "governor_state": self.governor.state,  # RUN, THROTTLED or PAUSED
+            "job_slots": self.allocator.max_jobs,  # Jobs this device runs concurrently
+            "free_slots": free_slots,
+            "core_allocation": self.allocator.snapshot(),  # Cores pinned per running job
             "status": self.status
         }
     
+    def accepting_jobs(self) -> bool:
+        """Whether to take new jobs right now"""
+        if self.draining:
+            return False
+        if self.governor.intake_paused:
+            logger.debug("Intake paused by governor", extra={'fields': {'state': self.governor.state}})
+            return False
+        return self.allocator.free_slots() > 0
+    
+    def sync(self) -> bool:
+        """
+        One round trip that replaces the separate heartbeat, job check and result
+        retries: report metrics, free slots, running jobs and unacknowledged results,
+        and get back result acknowledgements and any number of job assignments
+        
+        Returns:
+            bool: False if the server doesn't support /sync and the legacy endpoints must be used
+        """
+        if time.monotonic() < self._legacy_until:
+            return False
+        accepting = self.accepting_jobs()
+        with self._jobs_lock:
+            running = list(self.jobs)
+            rejected = list(self.rejected_jobs)
+        # Carries a batch of whatever the outbox is failing to deliver on its own
+        results = self.outbox.retry_batch()
+        body = {
+            **self.get_metrics(),
+            'running_jobs': running,
+            'results': results,
+            'rejected_jobs': rejected,
+        }
+        if not accepting:
+            body['free_slots'] = 0
+        try:
+            polled_at = time.time()
+            response = self.session.post(f"{API_BASE_URL}/sync", json=body, timeout=5)
+            if response.status_code in SYNC_UNSUPPORTED:
+                logger.info("Server has no /sync endpoint, using separate heartbeat and job check")
+                self._legacy_until = time.monotonic() + SYNC_RETRY_INTERVAL
+                return False
+            response.raise_for_status()
+            data = response.json()
+        except (requests.RequestException, ValueError) as e:
+            # Silently continue on error - don't disrupt the UI
+            logger.warning("Sync failed: %s", e)
+            return True
+        polled = (polled_at, time.time())
+        
+        with self._jobs_lock:
+            self.rejected_jobs = [j for j in self.rejected_jobs if j not in rejected]
+        self.outbox.acknowledge(data.get('acknowledged') or [])
+        for job_id in data.get('cancel') or []:
+            self.cancel_job(job_id)
+        for job in data.get('jobs') or []:
+            if not (self.accepting_jobs() and self.start_job(job, polled=polled)):
+                with self._jobs_lock:
+                    self.rejected_jobs.append(job['id'])
+        return True
+    
+    def cancel_job(self, job_id: str) -> bool:
+        """
+        Stop a running job at the requester's request. The executor kills its process
+        tree and the sandbox is removed; the slot is then freed and the loop woken to
+        pick up the next job
+        
+        Returns:
+            bool: False if the job isn't running here
+        """
+        with self._jobs_lock:
+            event = self.cancel_events.get(str(job_id))
+        if event is None or event.is_set():
+            return False
+        logger.info("Cancelling job", extra={'fields': {'job_id': job_id}})
+        event.set()
+        return True
+    
+    def kill_jobs(self):
+        """Kill every running job's process tree right away, e.g. when exiting without a drain"""
+        for pid in self.job_pids():
+            kill_process_tree(pid)
+    
+    def results_delivered(self, job_ids: List[str]):
+        """Called by the outbox once the server has stored results"""
+        for job_id in job_ids:
+            trace = JobTrace(job_id, AGENT)
+            trace.mark('acknowledged')
+            trace.save()
+            logger.info("Result delivered", extra={'fields': {'job_id': job_id}})
+    
     def send_heartbeat(self):
         """Send heartbeat to server"""
         try:
             metrics = self.get_metrics()
-            response = requests.post(
+            response = self.session.post(
                 f"{API_BASE_URL}/heartbeat", # Use configured API URL
                 json=metrics,
                 timeout=5  # Add timeout
             )
             response.raise_for_status()
-        except requests.RequestException:
+            try:
+                cancelled = (response.json() or {}).get('cancel') or []
+            except (ValueError, AttributeError):
+                cancelled = []
+            for job_id in cancelled:
+                self.cancel_job(job_id)
+        except requests.RequestException as e:
             # Silently continue on error - don't disrupt the UI
-            pass
+            logger.warning("Heartbeat failed: %s", e)
     
-    def execute_job(self, job_data: Dict):
+    def execute_job(self, job_data: Dict, trace: JobTrace, cancel: threading.Event):
         """Execute the job in a separate thread"""
-        stdout, stderr = execute_code(job_data)
-        success = update_job_status(job_data['id'], stdout, stderr)
+        job_id = job_data['id']
+        allocation = self.allocator.allocations.get(job_id) or {}
+        logger.info("Executing job", extra={'fields': {'job_id': job_id, 'cores': allocation.get('cores')}})
+        try:
+            stdout, stderr, info = execute_code(job_data, on_spawn=lambda p: self._job_spawned(job_id, p),
+                                                trace=trace, cancel=cancel, cpus=allocation.get('cores'))
+        finally:
+            with self._jobs_lock:
+                self.job_processes.pop(job_id, None)
+            self.allocator.release(job_id)
+        if info.get('cancelled'):
+            trace.mark('cancelled')
+            # The slot is free now; don't wait for the next tick to fill it
+            self._wake_event.set()
+        # Declared artifacts, and streams too big to return inline, are uploaded next to the result
+        output_files = info.pop('output_files')
+        files = dict(info.pop('artifact_files', {}))
+        for name, path in output_files.items():
+            files[f"{OUTPUT_PREFIX}{name}.log"] = path
+        info['full_output'] = sorted(output_files)
+        if files:
+            with trace.span('upload'):
+                upload = ArtifactUpload.stage(job_id, files)
+                info['artifacts'] = upload.names
+                info['artifacts_complete'] = upload.upload()
+        shutil.rmtree(OUTPUT_SPOOL_DIR / str(job_id), ignore_errors=True)
+        trace.mark('queued')
+        # The requester merges these into its own trace of the job
+        info['trace'] = list(trace.events)
+        trace.save()
+        # Delivered in the background so this slot's thread is done right away
+        self.outbox.put(result_payload(job_id, stdout, stderr, info))
+        logger.info("Job finished", extra={'fields': {'job_id': job_id}})
         
-        if success:
-            # Clear the job data after successful update
-            self.current_job = None
+        with self._jobs_lock:
+            self.jobs.pop(job_id, None)
+            self.job_threads.pop(job_id, None)
+            self.cancel_events.pop(job_id, None)
+            remaining = list(self.jobs.values())
+        # Clear the job data once nothing is running
+        self.current_job = remaining[-1] if remaining else None
+        if not remaining:
             clear_current_job()
     
+    def _job_spawned(self, job_id: str, process: subprocess.Popen):
+        with self._jobs_lock:
+            self.job_processes[job_id] = process
+        self.allocator.pin(job_id, process.pid)
+        # Apply the governor's current state right away instead of waiting for the next tick
+        self.governor.enforce()
+    
+    def start_job(self, job: Dict, polled: Optional[Tuple[float, float]] = None) -> bool:
+        """
+        Claim a slot for a received job and run it in its own thread
+
+        Args:
+            job: The job as sent by the server
+            polled: Start and end time of the request that delivered it, for the trace
+
+        Returns:
+            bool: False if there was no free slot for it
+        """
+        job_data = {
+            'id': job['id'],
+            'lang': job['lang'],
+            'code': job.get('code', ''),
+            'filename': job['filename'],
+            'bundle': job.get('bundle'),
+            'entry': job.get('entry'),
+            'requirements': job.get('requirements'),
+            'args': job.get('args') or [],
+            'artifacts': job.get('artifacts') or [],
+            'profile': job.get('profile') or []
+        }
+        if job_data['id'] in self.jobs:
+            return True  # Already running, e.g. the server re-sent it
+        if self.allocator.allocate(job_data['id']) is None:
+            logger.warning("No free job slot, ignoring job", extra={'fields': {'job_id': job_data['id']}})
+            return False
+        
+        trace = JobTrace(job_data['id'], AGENT)
+        if polled:
+            trace.add('poll', *polled)
+        trace.mark('received')
+        
+        # Store the job data both in memory and config
+        cancel = threading.Event()
+        thread = threading.Thread(target=self.execute_job, args=(job_data, trace, cancel), daemon=True)
+        with self._jobs_lock:
+            self.jobs[job_data['id']] = job_data
+            self.job_threads[job_data['id']] = thread
+            self.cancel_events[job_data['id']] = cancel
+        self.current_job = job_data
+        set_current_job(job_data)
+        logger.info("Job received", extra={'fields': {'job_id': job_data['id']}})
+        thread.start()
+        return True
+    
     def check_for_jobs(self):
         """Check for any queued jobs for this device"""
+        if not self.accepting_jobs():
+            return
         try:
             user_id = get_user_id()
             if not user_id:
                 return
                 
-            response = requests.get(
+            polled_at = time.time()
+            response = self.session.get(
                 f"{API_BASE_URL}/check-for-jobs/{user_id}", # Use configured API URL
                 timeout=5
             )
@@ -91,57 +352,150 @@ class HeartbeatMonitor:
             data = response.json()
             
             if data.get('job'):
-                # Store the job data both in memory and config
-                self.current_job = {
-                    'id': data['job']['id'],
-                    'lang': data['job']['lang'],
-                    'code': data['job']['code'],
-                    'filename': data['job']['filename']
-                }
-                set_current_job(self.current_job)
-                
-                # Start execution in a separate thread
-                if not self.execution_thread or not self.execution_thread.is_alive():
-                    self.execution_thread = threading.Thread(
-                        target=self.execute_job,
-                        args=(self.current_job,),
-                        daemon=True
-                    )
-                    self.execution_thread.start()
-            else:
-                self.current_job = None
-                clear_current_job()
+                self.start_job(data['job'], polled=(polled_at, time.time()))
                 
-        except requests.RequestException:
+        except requests.RequestException as e:
             # Silently continue on error - don't disrupt the UI
-            pass
+            logger.warning("Job check failed: %s", e)
+    
+    def maybe_calibrate(self):
+        """Refresh the performance calibration when no job is running and the host is idle"""
+        if self.jobs:
+            return
+        # Load average rather than cpu_percent(): psutil keeps one cpu_percent sample
+        # per thread, and this thread's window, just reset by the tick, is milliseconds long
+        load = psutil.getloadavg()[0] * 100.0 / (psutil.cpu_count(logical=True) or 1)
+        if load > CALIBRATION_IDLE_LOAD:
+            return
+        try:
+            calibrate_if_stale()
+        except Exception as e:
+            logger.warning("Calibration failed: %s", e)
+        # Start the next cpu_load window after the benchmark, so it isn't reported as load
+        psutil.cpu_percent(interval=None)
+    
+    def resume_uploads(self):
+        """Retry interrupted artifact uploads in the background"""
+        threading.Thread(target=resume_pending_uploads, daemon=True).start()
+    
+    def tick(self):
+        """Report to the server and pick up jobs, in one round trip if it supports /sync"""
+        if not self.sync():
+            self.send_heartbeat()
+            self.check_for_jobs()  # Check for jobs in the same interval
     
     def heartbeat_loop(self):
         """Main heartbeat and job checking loop"""
+        next_full_tick = 0.0
+        # While jobs run, syncs start frequent and back off to the heartbeat interval;
+        # a new set of running jobs starts the backoff over
+        polled_jobs = set()
+        job_sync_wait = 0.0
         while self.running:
-            self.send_heartbeat()
-            self.check_for_jobs()  # Check for jobs in the same interval
-            time.sleep(20)  # Wait for 20 seconds
+            # Upload retries and calibration only run at the regular interval, not
+            # on the quick syncs made while jobs are running
+            full_tick = time.monotonic() >= next_full_tick
+            try:
+                if full_tick:
+                    next_full_tick = time.monotonic() + HEARTBEAT_INTERVAL
+                    self.resume_uploads()
+                self.tick()
+                if full_tick:
+                    self.maybe_calibrate()
+            except Exception as e:
+                # E.g. a malformed job or server response; one bad tick mustn't end the loop
+                logger.warning("Heartbeat tick failed: %s", e, exc_info=True)
+            running = set(self.jobs)
+            if running and running != polled_jobs:
+                job_sync_wait = float(get_setting('job_sync_seconds', DEFAULT_JOB_SYNC_SECONDS))
+            elif running:
+                job_sync_wait = min(job_sync_wait * 2, HEARTBEAT_INTERVAL)
+            polled_jobs = running
+            wait = max(0.0, next_full_tick - time.monotonic())
+            if running:
+                wait = min(wait, job_sync_wait)
+            self._wake_event.wait(wait)
+            self._wake_event.clear()
     
     def start(self):
         """Start the heartbeat monitor"""
         if not self.running:
             self.running = True
+            self.draining = False
+            self._wake_event.clear()
+            interrupted = get_current_job()
+            if interrupted:
+                # Left over from a previous run that stopped mid-job
+                logger.warning("Discarding interrupted job", extra={'fields': {'job_id': interrupted.get('id')}})
+                clear_current_job()
+            self.governor.start()
+            self.outbox.start()
+            # The loop sends the initial heartbeat and checks for jobs right away
             self.thread = threading.Thread(target=self.heartbeat_loop, daemon=True)
             self.thread.start()
-            # Send initial heartbeat and check for jobs
-            self.send_heartbeat()
-            self.check_for_jobs()
     
     def stop(self):
         """Stop the heartbeat monitor"""
         self.running = False
+        self.draining = True
+        self._wake_event.set()
         if self.thread:
             self.thread.join(timeout=1)
             self.thread = None
         # Wait for any executing job to finish
-        if self.execution_thread and self.execution_thread.is_alive():
-            self.execution_thread.join(timeout=1)
+        for thread in list(self.job_threads.values()):
+            thread.join(timeout=1)
+        self.governor.stop()
+        self.outbox.stop()
+        self.flush_results()
+    
+    def is_alive(self) -> bool:
+        """Whether the heartbeat loop is still running"""
+        return self.thread is not None and self.thread.is_alive()
+    
+    def drain(self, timeout: Optional[float] = None) -> bool:
+        """
+        Stop accepting jobs and wait for the running ones to finish
+        
+        Args:
+            timeout: Maximum seconds to wait for running jobs, None waits forever
+            
+        Returns:
+            bool: True if no job is left running, False if the timeout expired
+        """
+        self.running = False
+        self.draining = True
+        self._wake_event.set()
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join(timeout=HEARTBEAT_INTERVAL)
+            self.thread = None
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for job_id, thread in list(self.job_threads.items()):
+            logger.info("Draining running job", extra={'fields': {'job_id': job_id}})
+            thread.join(timeout=None if deadline is None else max(0, deadline - time.monotonic()))
+        drained = not any(t.is_alive() for t in list(self.job_threads.values()))
+        if not drained:
+            # Don't leave jobs running behind us: cancel them (before the governor
+            # resumes any it stopped) and give the executor time to kill them
+            for job_id in list(self.job_threads):
+                self.cancel_job(job_id)
+            deadline = time.monotonic() + PROFILE_GRACE_SECONDS + 2 * WAIT_INTERVAL
+            for thread in list(self.job_threads.values()):
+                thread.join(timeout=max(0, deadline - time.monotonic()))
+            self.kill_jobs()
+        self.governor.stop()
+        self.outbox.stop()
+        self.flush_results()
+        # Tell the server we're going away so it stops routing jobs here,
+        # and hand over any results it hasn't acknowledged yet
+        self.tick()
+        return drained
+    
+    def flush_results(self):
+        """Deliver queued results before stopping; what can't be sent waits on disk"""
+        if not self.outbox.drain(timeout=OUTBOX_DRAIN_TIMEOUT):
+            logger.warning("Results left undelivered, they will be sent on the next start",
+                           extra={'fields': {'job_ids': [r['job_id'] for r in self.outbox.pending()]}})
     
     def set_status(self, status: str):
         """Update the status"""
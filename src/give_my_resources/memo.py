@@ -0,0 +1,181 @@
+"""
+Requester-side result memoization for deterministic jobs
+"""
+import hashlib
+import json
+import os
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+from .config import CONFIG_DIR, get_setting, write_atomic
+
+MEMO_DIR = CONFIG_DIR / 'results'
+PENDING_FILE = MEMO_DIR / 'pending.json'
+PENDING_LOCK = MEMO_DIR / 'pending.lock'
+
+# Defaults for the settings read via get_setting
+DEFAULT_MEMO_TTL_HOURS = 7 * 24
+DEFAULT_MEMO_MAX_MB = 100
+
+# Agent-side failures say nothing about the job's own output, so they aren't cached
+INFRA_ERRORS = (
+    "Execution timed out",
+    "Error executing code",
+    "Error preparing environment",
+    "Job cancelled",
+    "Job stopped for over",
+)
+
+def memo_key(job_data: Dict) -> str:
+    """
+    Hash everything that determines a deterministic job's output: the code (inline or
+    bundle hash), language, requested runtime, requirements and arguments. Which
+    runtime actually produced a result is only known afterwards, so lookup() checks
+    it against the requested one
+    """
+    code_hash = job_data.get('bundle') or hashlib.sha256(job_data.get('code', '').encode()).hexdigest()
+    material = {
+        'code': code_hash,
+        'entry': job_data.get('entry') or job_data.get('filename'),
+        'lang': job_data['lang'],
+        'runtime': job_data.get('runtime', ''),
+        'requirements': job_data.get('requirements') or [],
+        'args': job_data.get('args') or [],
+    }
+    return hashlib.sha256(json.dumps(material, sort_keys=True).encode()).hexdigest()
+
+def _entry_path(key: str):
+    return MEMO_DIR / f"{key}.json"
+
+def _ttl_seconds() -> float:
+    return float(get_setting('memo_ttl_hours', DEFAULT_MEMO_TTL_HOURS)) * 3600
+
+def runtime_matches(requested: str, actual: Optional[str]) -> bool:
+    """
+    Whether a job that ran on `actual` (e.g. python3.11.7) satisfies a requested
+    runtime: the same version, or one it narrows down (python3.11, python3)
+    """
+    if not requested:
+        return True
+    return bool(actual) and (actual == requested or actual.startswith(requested + '.'))
+
+def lookup(key: str, runtime: str = '') -> Optional[Dict]:
+    """
+    Return the cached result for a key, or None if missing or expired, or if it was
+    produced on a runtime other than the requested one
+    """
+    path = _entry_path(key)
+    try:
+        with open(path, 'r') as f:
+            entry = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+    if time.time() - entry.get('stored_at', 0) > _ttl_seconds():
+        path.unlink()
+        return None
+    if not runtime_matches(runtime, entry.get('runtime')):
+        return None
+    os.utime(path)  # Mark as recently used for eviction
+    return entry
+
+def store(key: str, job_id: str, stdout: str, stderr: str, runtime: Optional[str] = None):
+    """Cache a finished job's output, with the runtime the agent ran it on, and evict old entries"""
+    MEMO_DIR.mkdir(parents=True, exist_ok=True)
+    entry = {
+        'job_id': job_id,
+        'stdout': stdout,
+        'stderr': stderr,
+        'runtime': runtime,
+        'stored_at': int(time.time()),
+    }
+    write_atomic(_entry_path(key), json.dumps(entry))
+    evict()
+
+def evict():
+    """Drop expired entries, then least recently used ones until under the size limit"""
+    if not MEMO_DIR.exists():
+        return
+    now = time.time()
+    ttl = _ttl_seconds()
+    entries = []
+    for path in MEMO_DIR.glob('*.json'):
+        if path == PENDING_FILE:
+            continue
+        stat = path.stat()
+        try:
+            with open(path, 'r') as f:
+                stored_at = json.load(f).get('stored_at', 0)
+        except (OSError, json.JSONDecodeError):
+            stored_at = 0
+        if now - stored_at > ttl:
+            path.unlink()
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    limit = float(get_setting('memo_max_mb', DEFAULT_MEMO_MAX_MB)) * 1024 * 1024
+    for _, size, path in sorted(entries):
+        if total <= limit:
+            break
+        path.unlink()
+        total -= size
+
+def _load_pending() -> Dict[str, str]:
+    try:
+        with open(PENDING_FILE, 'r') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+@contextmanager
+def _pending_locked() -> Iterator[None]:
+    """
+    Hold an exclusive lock on the pending list: `gmr submit` and the menu's background
+    refresh may update it from different processes at once
+    """
+    MEMO_DIR.mkdir(parents=True, exist_ok=True)
+    with open(PENDING_LOCK, 'a+') as f:
+        if os.name == 'nt':
+            import msvcrt
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if os.name == 'nt':
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+def _save_pending(pending: Dict[str, str]):
+    write_atomic(PENDING_FILE, json.dumps(pending))
+
+def remember_pending(job_id: str, key: str):
+    """Remember which cache key a submitted job will fill once it finishes"""
+    with _pending_locked():
+        pending = _load_pending()
+        pending[str(job_id)] = key
+        _save_pending(pending)
+
+def record_results(jobs: List[Dict]):
+    """Cache the output of any finished jobs that were submitted as deterministic"""
+    if not PENDING_FILE.exists():
+        return
+    finished = []
+    with _pending_locked():
+        pending = _load_pending()
+        for job in jobs:
+            job_id = str(job.get('id'))
+            if job_id in pending and job.get('status') == 'FINISHED':
+                finished.append((pending.pop(job_id), job))
+        if finished:
+            _save_pending(pending)
+    for key, job in finished:
+        stdout = job.get('stdout') or job.get('stdoutt') or ''
+        stderr = job.get('stderr') or ''
+        if not any(marker in stderr for marker in INFRA_ERRORS):
+            store(key, str(job.get('id')), stdout, stderr, runtime=job.get('runtime_version'))
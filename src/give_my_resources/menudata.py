@@ -0,0 +1,117 @@
+"""
+Background-refreshed data for the interactive menu
+"""
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+from .config import get_setting
+
+# Defaults for the settings read via get_setting
+DEFAULT_MENU_REFRESH_SECONDS = 30
+
+# A snapshot this many refresh intervals old is shown as stale
+STALE_INTERVALS = 3
+
+# Errors are shown inline in the menu, so long ones are cut
+MAX_ERROR_LENGTH = 60
+
+logger = logging.getLogger(__name__)
+
+class MenuData:
+    """
+    Fetches each data source (budget, devices, jobs...) in its own background
+    thread, all at once on start and then on a schedule, so the menu can draw
+    from the latest snapshot instead of waiting on the API
+    """
+
+    def __init__(self, sources: Dict[str, Callable[[], Any]]):
+        """
+        Args:
+            sources: Fetch function per name; each returns the data or raises on failure
+        """
+        self.sources = sources
+        self.interval = float(get_setting('menu_refresh_seconds', DEFAULT_MENU_REFRESH_SECONDS))
+        self.snapshots: Dict[str, Dict] = {}
+        self.running = False
+        self._lock = threading.Lock()
+        self._wake = {name: threading.Event() for name in sources}
+        self._fetched = {name: threading.Event() for name in sources}
+
+    def _fetch(self, name: str):
+        try:
+            value = self.sources[name]()
+            error = None
+        except Exception as e:
+            logger.debug("Menu data refresh failed", extra={'fields': {'source': name, 'error': str(e)}})
+            value, error = None, str(e) or type(e).__name__
+        with self._lock:
+            snapshot = self.snapshots.setdefault(name, {'value': None, 'updated_at': None})
+            snapshot['error'] = error
+            if error is None:
+                # On failure the last good value is kept and shown as stale
+                snapshot['value'] = value
+                snapshot['updated_at'] = time.time()
+        self._fetched[name].set()
+
+    def _run(self, name: str):
+        while self.running:
+            self._fetch(name)
+            self._wake[name].wait(self.interval)
+            self._wake[name].clear()
+
+    def start(self):
+        if not self.running:
+            self.running = True
+            for name in self.sources:
+                threading.Thread(target=self._run, args=(name,), daemon=True).start()
+
+    def stop(self):
+        self.running = False
+        for event in self._wake.values():
+            event.set()
+
+    def refresh(self, name: str):
+        """Fetch a source now instead of at its next scheduled refresh"""
+        self._wake[name].set()
+
+    def get(self, name: str, wait: float = 0) -> Optional[Dict]:
+        """
+        The latest snapshot of a source: {'value', 'updated_at', 'error'}, or None if
+        the first fetch hasn't finished
+
+        Args:
+            wait: Seconds to wait for the first fetch if it is still running
+        """
+        if wait:
+            self._fetched[name].wait(wait)
+        with self._lock:
+            snapshot = self.snapshots.get(name)
+            return dict(snapshot) if snapshot else None
+
+    def is_stale(self, snapshot: Optional[Dict]) -> bool:
+        if not snapshot or snapshot['updated_at'] is None:
+            return True
+        return time.time() - snapshot['updated_at'] > self.interval * STALE_INTERVALS
+
+def _format_age(seconds: float) -> str:
+    if seconds < 60:
+        return f"{int(seconds)}s"
+    if seconds < 3600:
+        return f"{int(seconds // 60)}m"
+    return f"{int(seconds // 3600)}h"
+
+def _short_error(error: str) -> str:
+    return error if len(error) <= MAX_ERROR_LENGTH else error[:MAX_ERROR_LENGTH - 3] + "..."
+
+def freshness(snapshot: Optional[Dict], stale: bool) -> str:
+    """A short note on how current a snapshot is, for display next to its data"""
+    if snapshot is None:
+        return "loading..."
+    if snapshot['updated_at'] is None:
+        return f"unavailable: {_short_error(snapshot['error'])}"
+    age = f"updated {_format_age(time.time() - snapshot['updated_at'])} ago"
+    if snapshot['error']:
+        return f"{age}, refresh failed: {_short_error(snapshot['error'])}"
+    return f"{age}, stale" if stale else age
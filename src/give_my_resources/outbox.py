@@ -0,0 +1,243 @@
+"""
+Asynchronous, batched delivery of job results
+"""
+import gzip
+import json
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+import requests
+
+from .config import CONFIG_DIR, API_BASE_URL, get_setting, write_atomic
+from .executor import update_job_status
+
+OUTBOX_DIR = CONFIG_DIR / 'outbox'
+
+# Defaults for the settings read via get_setting
+DEFAULT_OUTBOX_BATCH_SIZE = 50      # Results per request
+DEFAULT_OUTBOX_BATCH_KB = 512       # Uncompressed JSON per request
+DEFAULT_OUTBOX_FLUSH_SECONDS = 1.0  # Longest a result waits for others to share its request
+
+# Backoff between failed flushes, doubling up to the maximum
+RETRY_MIN_SECONDS = 1
+RETRY_MAX_SECONDS = 60
+
+# Seconds before trying /update-jobs again after the server turned out not to support it
+BATCH_RETRY_INTERVAL = 600
+
+# Status codes meaning the server predates the batch endpoint
+BATCH_UNSUPPORTED = (404, 405, 501)
+
+logger = logging.getLogger(__name__)
+
+class ResultOutbox:
+    """
+    Queues finished jobs' results and delivers them in the background, several per
+    gzip-compressed request. Each result stays queued (also on disk, so it survives
+    an agent restart) until the server acknowledges its job ID
+    """
+
+    def __init__(self, session: requests.Session,
+                 on_acknowledged: Optional[Callable[[List[str]], None]] = None):
+        self.session = session
+        self.on_acknowledged = on_acknowledged
+        self.results: Dict[str, Dict] = {}
+        self._queued_at: Dict[str, float] = {}
+        self._sizes: Dict[str, int] = {}
+        self._condition = threading.Condition()
+        self._retry_at = 0.0
+        self._backoff = RETRY_MIN_SECONDS
+        self._legacy_until = 0.0
+        self.running = False
+        self.thread: Optional[threading.Thread] = None
+
+    def _path(self, job_id: str):
+        return OUTBOX_DIR / f"{job_id}.json"
+
+    def _load(self):
+        """Pick up results left undelivered by a previous run"""
+        if not OUTBOX_DIR.exists():
+            return
+        for path in OUTBOX_DIR.glob('*.json'):
+            try:
+                with open(path, 'r') as f:
+                    payload = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                path.unlink()
+                continue
+            job_id = str(payload['job_id'])
+            if job_id in self.results:
+                continue
+            self.results[job_id] = payload
+            self._queued_at[job_id] = 0.0  # Overdue: send with the first flush
+            self._sizes[job_id] = path.stat().st_size
+
+    def put(self, payload: Dict):
+        """Queue a result (as built by executor.result_payload) for delivery"""
+        job_id = str(payload['job_id'])
+        data = json.dumps(payload)
+        OUTBOX_DIR.mkdir(parents=True, exist_ok=True)
+        write_atomic(self._path(job_id), data)
+        with self._condition:
+            self.results[job_id] = payload
+            self._queued_at[job_id] = time.monotonic()
+            self._sizes[job_id] = len(data)
+            self._condition.notify()
+
+    def pending(self) -> List[Dict]:
+        with self._condition:
+            return list(self.results.values())
+
+    def retry_batch(self) -> List[Dict]:
+        """
+        One batch of results for another request to carry while the outbox's own
+        delivery is failing and backing off. Empty otherwise, so results aren't sent
+        twice while the outbox is still delivering them
+        """
+        with self._condition:
+            if time.monotonic() >= self._retry_at:
+                return []
+            return [self.results[job_id] for job_id in self._batch()]
+
+    def acknowledge(self, job_ids: List[str]):
+        """Drop results the server has stored, however they were delivered"""
+        delivered = []
+        with self._condition:
+            for job_id in map(str, job_ids):
+                if self.results.pop(job_id, None) is not None:
+                    delivered.append(job_id)
+                self._queued_at.pop(job_id, None)
+                self._sizes.pop(job_id, None)
+        for job_id in delivered:
+            try:
+                self._path(job_id).unlink()
+            except OSError:
+                pass
+        if delivered and self.on_acknowledged:
+            self.on_acknowledged(delivered)
+
+    def _batch(self) -> List[str]:
+        """Oldest results that fit in one request"""
+        max_count = int(get_setting('outbox_batch_size', DEFAULT_OUTBOX_BATCH_SIZE))
+        max_bytes = int(get_setting('outbox_batch_kb', DEFAULT_OUTBOX_BATCH_KB)) * 1024
+        batch, size = [], 0
+        for job_id in sorted(self._queued_at, key=self._queued_at.get):
+            if batch and (len(batch) >= max_count or size + self._sizes[job_id] > max_bytes):
+                break
+            batch.append(job_id)
+            size += self._sizes[job_id]
+        return batch
+
+    def _wait_time(self) -> Optional[float]:
+        """
+        Seconds until a flush is due: a full batch is waiting, or the oldest result
+        has waited long enough. None if there is nothing to send
+        """
+        if not self.results:
+            return None
+        now = time.monotonic()
+        if now < self._retry_at:
+            return self._retry_at - now
+        max_count = int(get_setting('outbox_batch_size', DEFAULT_OUTBOX_BATCH_SIZE))
+        max_bytes = int(get_setting('outbox_batch_kb', DEFAULT_OUTBOX_BATCH_KB)) * 1024
+        if len(self.results) >= max_count or sum(self._sizes.values()) >= max_bytes:
+            return 0.0
+        flush_after = float(get_setting('outbox_flush_seconds', DEFAULT_OUTBOX_FLUSH_SECONDS))
+        return max(0.0, min(self._queued_at.values()) + flush_after - now)
+
+    def _send(self, payloads: List[Dict]) -> List[str]:
+        """
+        Deliver one batch
+
+        Returns:
+            Job IDs the server acknowledged
+        """
+        if time.monotonic() >= self._legacy_until:
+            body = gzip.compress(json.dumps({'results': payloads}).encode())
+            response = self.session.post(
+                f"{API_BASE_URL}/update-jobs",
+                data=body,
+                headers={'Content-Type': 'application/json', 'Content-Encoding': 'gzip'},
+                timeout=10
+            )
+            if response.status_code not in BATCH_UNSUPPORTED:
+                response.raise_for_status()
+                return [str(job_id) for job_id in (response.json() or {}).get('acknowledged', [])]
+            logger.info("Server has no /update-jobs endpoint, delivering results one by one")
+            self._legacy_until = time.monotonic() + BATCH_RETRY_INTERVAL
+
+        delivered = []
+        for payload in payloads:
+            extra = {k: v for k, v in payload.items() if k not in ('job_id', 'stdout', 'stderr')}
+            if update_job_status(payload['job_id'], payload['stdout'], payload['stderr'], extra,
+                                 session=self.session):
+                delivered.append(str(payload['job_id']))
+        return delivered
+
+    def flush(self) -> bool:
+        """
+        Send one batch now, whether or not it is due
+
+        Returns:
+            bool: True if the batch was delivered in full
+        """
+        with self._condition:
+            batch = self._batch()
+            payloads = [self.results[job_id] for job_id in batch]
+        if not payloads:
+            return True
+        try:
+            delivered = self._send(payloads)
+        except (requests.RequestException, ValueError) as e:
+            logger.warning("Result delivery failed: %s", e)
+            delivered = []
+        self.acknowledge(delivered)
+        with self._condition:
+            # Results may also have been acknowledged by a sync in the meantime
+            if any(job_id in self.results for job_id in batch):
+                self._retry_at = time.monotonic() + self._backoff
+                self._backoff = min(self._backoff * 2, RETRY_MAX_SECONDS)
+                return False
+            self._retry_at = 0.0
+            self._backoff = RETRY_MIN_SECONDS
+            return True
+
+    def drain(self, timeout: float) -> bool:
+        """
+        Deliver everything queued, e.g. before the agent exits
+
+        Returns:
+            bool: True if nothing is left undelivered
+        """
+        deadline = time.monotonic() + timeout
+        while self.results and time.monotonic() < deadline:
+            if not self.flush():
+                break  # Server unreachable; the results stay on disk for the next run
+        return not self.results
+
+    def loop(self):
+        while self.running:
+            with self._condition:
+                wait = self._wait_time()
+                if wait is None or wait > 0:
+                    # put() and stop() notify, so this also wakes for new results
+                    self._condition.wait(timeout=wait)
+                    continue
+            self.flush()
+
+    def start(self):
+        if not self.running:
+            self._load()
+            self.running = True
+            self.thread = threading.Thread(target=self.loop, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        with self._condition:
+            self.running = False
+            self._condition.notify()
+        if self.thread:
+            self.thread.join(timeout=1)
+            self.thread = None
@@ -0,0 +1,116 @@
+"""
+Bounded-memory capture of job output with disk spill and head/tail truncation
+"""
+import threading
+from pathlib import Path
+from typing import IO, Optional
+
+from .config import CONFIG_DIR, get_setting
+
+OUTPUT_SPOOL_DIR = CONFIG_DIR / 'outputs'
+
+# Defaults for the settings read via get_setting
+DEFAULT_OUTPUT_MEMORY_KB = 1024  # Held in memory before spilling to disk
+DEFAULT_OUTPUT_HEAD_KB = 32      # Kept from the start of a truncated stream
+DEFAULT_OUTPUT_TAIL_KB = 32      # Kept from the end of a truncated stream
+
+READ_SIZE = 64 * 1024
+
+class OutputCapture:
+    """
+    Collects one output stream. Up to the memory limit it is buffered in memory,
+    beyond that it goes to a spool file; only the head and tail are kept for the
+    inline result
+    """
+
+    def __init__(self, name: str, spool_path: Path):
+        self.name = name
+        self.spool_path = spool_path
+        self.memory_limit = int(get_setting('output_memory_kb', DEFAULT_OUTPUT_MEMORY_KB)) * 1024
+        self.head_limit = int(get_setting('output_head_kb', DEFAULT_OUTPUT_HEAD_KB)) * 1024
+        self.tail_limit = int(get_setting('output_tail_kb', DEFAULT_OUTPUT_TAIL_KB)) * 1024
+        self.total_bytes = 0
+        self._buffer = bytearray()  # Everything, until we spill
+        self._head = bytearray()
+        self._tail = bytearray()
+        self._spill: Optional[IO[bytes]] = None
+        self._extra = ""  # Agent messages appended after the job's own output
+        self.thread: Optional[threading.Thread] = None
+        # Once closed, output still arriving (from a reader thread that outlived
+        # close()) is dropped instead of touching the closed spool or the result
+        self._closed = False
+        self._lock = threading.Lock()
+
+    @property
+    def truncated(self) -> bool:
+        return self.total_bytes > self.head_limit + self.tail_limit
+
+    def feed(self, data: bytes):
+        with self._lock:
+            if not self._closed:
+                self._feed(data)
+
+    def _feed(self, data: bytes):
+        self.total_bytes += len(data)
+        if len(self._head) < self.head_limit:
+            self._head += data[:self.head_limit - len(self._head)]
+        self._tail += data
+        if len(self._tail) > self.tail_limit:
+            del self._tail[:len(self._tail) - self.tail_limit]
+
+        if self._spill is None and self.total_bytes > self.memory_limit:
+            self.spool_path.parent.mkdir(parents=True, exist_ok=True)
+            self._spill = open(self.spool_path, 'wb')
+            self._spill.write(self._buffer)
+            self._buffer = bytearray()
+        if self._spill is not None:
+            self._spill.write(data)
+        else:
+            self._buffer += data
+
+    def append(self, message: str):
+        """Add an agent message (e.g. a timeout notice) after the job's output"""
+        self._extra += message
+
+    def pump(self, stream: IO[bytes]):
+        """Read a pipe to EOF in a background thread"""
+        def run():
+            for block in iter(lambda: stream.read(READ_SIZE), b''):
+                self.feed(block)
+            stream.close()
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+
+    def close(self) -> Optional[Path]:
+        """
+        Finish capturing. If the inline result is truncated, the full output is
+        left in the spool file, whose path is returned
+        """
+        if self.thread:
+            # Grandchildren can hold the pipe open after the job exits
+            self.thread.join(timeout=5)
+        with self._lock:
+            self._closed = True
+            if self._spill is not None:
+                self._spill.close()
+            elif self.truncated:
+                self.spool_path.parent.mkdir(parents=True, exist_ok=True)
+                with open(self.spool_path, 'wb') as f:
+                    f.write(self._buffer)
+            self._buffer = bytearray()
+            return self.spool_path if self.truncated else None
+
+    def inline(self) -> str:
+        """The result text: everything if it fits, otherwise head and tail"""
+        if not self.truncated:
+            # Head and tail overlap or touch; stitch them back together
+            rest = self.total_bytes - len(self._head)
+            data = bytes(self._head) + (bytes(self._tail[-rest:]) if rest else b'')
+            return data.decode('utf-8', errors='replace') + self._extra
+        omitted = self.total_bytes - len(self._head) - len(self._tail)
+        return (
+            self._head.decode('utf-8', errors='replace')
+            + f"\n... [{omitted} bytes truncated, full {self.name} is available as an artifact] ...\n"
+            + self._tail.decode('utf-8', errors='replace')
+            + self._extra
+        )
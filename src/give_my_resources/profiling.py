@@ -0,0 +1,111 @@
+"""
+Opt-in profiling of Python jobs: cProfile for time, tracemalloc for memory
+"""
+import gzip
+import json
+import os
+import shutil
+from pathlib import Path
+from typing import Dict, List
+
+from .artifacts import OUTPUT_PREFIX
+
+PROFILE_ARTIFACT = f"{OUTPUT_PREFIX}profile.json.gz"
+
+# Profile kinds a job can ask for
+CPU = 'cpu'
+MEMORY = 'memory'
+
+# Stack depth tracemalloc records per allocation
+MEMORY_FRAMES = 10
+
+# Allocation sites kept in the profile; functions are all kept
+MEMORY_TOP = 100
+
+# Runs in the job's interpreter (which may be a cached venv without this package),
+# so it is passed with -c. It writes plain JSON rather than pstats/pickle data, so
+# rendering a profile from another machine never unmarshals untrusted objects.
+BOOTSTRAP = f'''
+import cProfile, json, os, pstats, runpy, signal, sys, tracemalloc
+out_path, memory, script = sys.argv[1], sys.argv[2] == "1", sys.argv[3]
+# The agent sends SIGTERM before killing a timed-out or cancelled job; unwinding
+# through the finally below still writes the profile
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+sys.argv = sys.argv[3:]
+root = os.path.dirname(os.path.abspath(script))
+sys.path[0] = root
+def rel(filename):
+    # Paths inside the sandbox mean nothing once it is gone
+    return os.path.relpath(filename, root) if filename.startswith(root + os.sep) else filename
+if memory:
+    tracemalloc.start({MEMORY_FRAMES})
+profiler = cProfile.Profile()
+try:
+    # Keep the script's globals alive so the memory snapshot still sees them
+    namespace = profiler.runcall(runpy.run_path, script, run_name="__main__")
+finally:
+    result = {{}}
+    if memory:
+        snapshot = tracemalloc.take_snapshot()
+        result["memory_peak"] = tracemalloc.get_traced_memory()[1]
+        # Stop tracing before working on the snapshot: with tracing on, every
+        # allocation made while filtering is traced too, which is very slow
+        tracemalloc.stop()
+        ignored = (tracemalloc.__file__, runpy.__file__, cProfile.__file__, "<frozen runpy>", "<string>")
+        sites = (
+            s for s in snapshot.statistics("lineno")
+            if s.traceback[0].filename not in ignored
+            and not s.traceback[0].filename.startswith("<frozen importlib._bootstrap")
+        )
+        result["allocations"] = [
+            {{"file": rel(s.traceback[0].filename), "line": s.traceback[0].lineno,
+              "size": s.size, "count": s.count}}
+            for s, _ in zip(sites, range({MEMORY_TOP}))
+        ]
+    result["functions"] = [
+        [rel(f), line, name, cc, nc, tt, ct]
+        for (f, line, name), (cc, nc, tt, ct, _) in pstats.Stats(profiler).stats.items()
+    ]
+    with open(out_path, "w") as f:
+        json.dump(result, f)
+'''
+
+def profile_command(python: str, script: Path, out_path: Path, kinds: List[str]) -> List[str]:
+    """Command that runs a Python script under the profiler, writing JSON to out_path"""
+    return [python, '-c', BOOTSTRAP, str(out_path), '1' if MEMORY in kinds else '0', str(script)]
+
+def compress_profile(path: Path) -> Path:
+    """Gzip the raw profile next to itself and return the compressed file"""
+    gz_path = path.with_name(path.name + '.gz')
+    with open(path, 'rb') as src, gzip.GzipFile(gz_path, 'wb', mtime=0) as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(path)
+    return gz_path
+
+def load_profile(path: Path) -> Dict:
+    with gzip.open(path, 'rt') as f:
+        return json.load(f)
+
+def _short_path(filename: str) -> str:
+    parts = Path(filename).parts
+    return str(Path(*parts[-2:])) if len(parts) > 2 else filename
+
+def top_functions(profile: Dict, n: int = 20, sort: str = 'tottime') -> List[Dict]:
+    """
+    The n functions with the most time, by own time ('tottime'), time including
+    callees ('cumtime') or number of calls ('calls')
+    """
+    keys = {'tottime': 5, 'cumtime': 6, 'calls': 4}
+    rows = sorted(profile.get('functions', []), key=lambda r: r[keys[sort]], reverse=True)[:n]
+    return [
+        {'function': f"{_short_path(f)}:{line}({name})" if line else name,
+         'calls': nc, 'primitive_calls': cc, 'tottime': tt, 'cumtime': ct}
+        for f, line, name, cc, nc, tt, ct in rows
+    ]
+
+def top_allocations(profile: Dict, n: int = 20) -> List[Dict]:
+    """The n source lines holding the most memory when the job finished"""
+    return [
+        {'site': f"{_short_path(a['file'])}:{a['line']}", 'size': a['size'], 'count': a['count']}
+        for a in profile.get('allocations', [])[:n]
+    ]
@@ -0,0 +1,189 @@
+"""
+Job building and submission for give-my-resources
+"""
+import os
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import requests
+
+from .config import get_user_id, API_BASE_URL
+from .bundle import BundleError, build_bundle, collect_files, upload_bundle
+from .envs import EnvError, normalize_requirements
+from . import memo, tracing
+
+def count_file_lines(filepath: str) -> int:
+    try:
+        with open(filepath, 'r') as f:
+            return sum(1 for _ in f)
+    except Exception:
+        return 0
+
+def count_bundle_lines(root: str, manifest: Dict) -> int:
+    """Count lines of code across the scripts included in a bundle"""
+    return sum(
+        count_file_lines(os.path.join(root, rel))
+        for rel in collect_files(Path(root), manifest)
+        if rel.endswith(('.py', '.js'))
+    )
+
+def calculate_price(num_lines: int) -> float:
+    return num_lines / 100
+
+def language_for(filename: str) -> str:
+    return 'python' if filename.endswith('.py') else 'javascript'
+
+def _normalize_requirements(requirements: List[str]) -> List[str]:
+    """Like envs.normalize_requirements, raising BundleError so submit reports it like other job errors"""
+    try:
+        return normalize_requirements(requirements)
+    except EnvError as e:
+        raise BundleError(str(e))
+
+def read_requirements(path: str) -> List[str]:
+    """Read a requirements.txt into a normalized list"""
+    with open(path, 'r') as f:
+        return _normalize_requirements(f.read().splitlines())
+
+def manifest_requirements(root: str, manifest: Dict) -> List[str]:
+    """Requirements declared by a bundle manifest, inline or as a path to a requirements file"""
+    declared = manifest.get('requirements') or []
+    if isinstance(declared, str):
+        return read_requirements(os.path.join(root, declared))
+    return _normalize_requirements(declared)
+
+def build_job(path: str, device_id: str, requirements_file: Optional[str] = None) -> Dict:
+    """
+    Build the job payload for a single script file or a bundle directory
+
+    Bundle directories are packed and uploaded here, so the payload only
+    carries the bundle hash. Python requirements come from the manifest's
+    "requirements" entry or from requirements_file; the device installs them
+    into a cached environment.
+
+    Raises:
+        BundleError: If the bundle can't be built or uploaded
+        IOError: If the script can't be read
+    """
+    if os.path.isdir(path):
+        archive, digest, manifest = build_bundle(Path(path))
+        try:
+            if not upload_bundle(archive, digest):
+                raise BundleError("Could not upload bundle, please try again later")
+        finally:
+            os.remove(archive)
+        job_data = {
+            'requester': get_user_id(),
+            'device_id': device_id,
+            'filename': manifest['entry'],
+            'lang': language_for(manifest['entry']),
+            'bundle': digest,
+            'entry': manifest['entry'],
+            'cost_usd': calculate_price(count_bundle_lines(path, manifest))
+        }
+        requirements = manifest_requirements(path, manifest)
+        if manifest.get('artifacts'):
+            job_data['artifacts'] = list(manifest['artifacts'])
+    else:
+        with open(path, 'r') as f:
+            code = f.read()
+        job_data = {
+            'requester': get_user_id(),
+            'device_id': device_id,
+            'filename': os.path.basename(path),
+            'lang': language_for(path),
+            'code': code,
+            'cost_usd': calculate_price(count_file_lines(path))
+        }
+        requirements = []
+
+    if requirements_file:
+        requirements = _normalize_requirements(requirements + read_requirements(requirements_file))
+    if requirements:
+        if job_data['lang'] != 'python':
+            raise BundleError("Requirements are only supported for Python jobs")
+        job_data['requirements'] = requirements
+    return job_data
+
+def submit_job(job_data: Dict, build_started: Optional[float] = None) -> Optional[Dict]:
+    """
+    Submit a job to the API, starting its local trace if the server returns an ID
+
+    Args:
+        job_data: The payload from build_job
+        build_started: When build_job was called, to trace bundle packing and upload
+
+    Returns:
+        The API response body (empty dict if it has none) on success, None otherwise
+    """
+    try:
+        submitted_at = time.time()
+        response = requests.post(
+            f"{API_BASE_URL}/submit-job",
+            json=job_data,
+            timeout=5
+        )
+        if response.status_code != 200:
+            return None
+        try:
+            body = response.json()
+        except ValueError:
+            body = {}
+        body = body if isinstance(body, dict) else {}
+        job_id = body.get('id') or body.get('job_id')
+        if job_id:
+            trace = tracing.JobTrace(job_id, tracing.REQUESTER)
+            if build_started:
+                trace.add('build', build_started, submitted_at)
+            trace.add('submit', submitted_at, time.time())
+            trace.save()
+        return body
+    except requests.RequestException:
+        return None
+
+def cancel_job(job_id: str) -> bool:
+    """
+    Ask the API to cancel a job: a queued job is dropped, a running one is killed
+    on its device the next time the device checks in
+
+    Returns:
+        bool: True if the API accepted the cancellation
+    """
+    try:
+        response = requests.post(
+            f"{API_BASE_URL}/cancel-job",
+            json={'job_id': job_id, 'requester': get_user_id()},
+            timeout=5
+        )
+        return response.status_code == 200
+    except requests.RequestException:
+        return False
+
+
+def fetch_jobs(user_id: str) -> List[Dict]:
+    """
+    Fetch the requester's jobs
+
+    Raises:
+        requests.RequestException: If the API can't be reached
+    """
+    response = requests.get(f"{API_BASE_URL}/jobs/{user_id}", timeout=5)
+    response.raise_for_status()
+    return response.json() or []
+
+def wait_for_job(user_id: str, job_id: str, timeout: float = 600, interval: float = 2) -> Optional[Dict]:
+    """Poll until the job is finished and return it, or None on timeout"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            jobs = fetch_jobs(user_id)
+            memo.record_results(jobs)
+            tracing.record_results(jobs)
+            for job in jobs:
+                if str(job.get('id')) == str(job_id) and job.get('status') == 'FINISHED':
+                    return job
+        except requests.RequestException:
+            pass
+        time.sleep(interval)
+    return None
@@ -0,0 +1,165 @@
+"""
+Per-job trace timelines, stored in Chrome trace event format
+"""
+import json
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+from .config import CONFIG_DIR, write_atomic
+
+TRACE_DIR = CONFIG_DIR / 'traces'
+
+# Trace "processes": which side of the job recorded a span
+REQUESTER = 1
+AGENT = 2
+PROCESS_NAMES = {REQUESTER: 'requester', AGENT: 'agent'}
+
+# Trace files older than this, or beyond this many, are deleted (oldest first)
+TRACE_MAX_AGE_DAYS = 14
+TRACE_MAX_FILES = 1000
+
+# Gaps between stages shorter than this (microseconds) aren't worth a line of their own
+MIN_GAP_US = 1000
+
+def _now_us() -> int:
+    # Wall clock, so spans from the requester and the agent line up (given synced clocks)
+    return int(time.time() * 1_000_000)
+
+def trace_path(job_id: str):
+    return TRACE_DIR / f"{job_id}.json"
+
+class JobTrace:
+    """Timestamped spans for one job, recorded on one side (requester or agent)"""
+
+    def __init__(self, job_id: str, process: int):
+        self.job_id = str(job_id)
+        self.process = process
+        self.events: List[Dict] = []
+        self._lock = threading.Lock()
+
+    def add(self, name: str, start: float, end: float, **args):
+        """Record a span from Unix timestamps (seconds)"""
+        event = {
+            'name': name, 'cat': 'job', 'ph': 'X',
+            'ts': int(start * 1_000_000), 'dur': max(0, int((end - start) * 1_000_000)),
+            'pid': self.process, 'tid': self.job_id,
+        }
+        if args:
+            event['args'] = args
+        with self._lock:
+            self.events.append(event)
+
+    @contextmanager
+    def span(self, name: str, **args):
+        """Record how long the body takes"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, start, time.time(), **args)
+
+    def mark(self, name: str, **args):
+        """Record a point in time"""
+        event = {'name': name, 'cat': 'job', 'ph': 'i', 's': 't', 'ts': _now_us(),
+                 'pid': self.process, 'tid': self.job_id}
+        if args:
+            event['args'] = args
+        with self._lock:
+            self.events.append(event)
+
+    def save(self):
+        """Merge the recorded events into the job's local trace file"""
+        merge_events(self.job_id, self.events)
+
+def load_events(job_id: str) -> List[Dict]:
+    try:
+        with open(trace_path(job_id), 'r') as f:
+            return [e for e in json.load(f).get('traceEvents', []) if e.get('ph') != 'M']
+    except (OSError, json.JSONDecodeError):
+        return []
+
+def merge_events(job_id: str, events: List[Dict]):
+    """Add events to a job's trace file, ignoring ones it already has"""
+    existing = load_events(job_id)
+    seen = {(e['pid'], e['name'], e['ts']) for e in existing}
+    merged = existing + [e for e in events if (e.get('pid'), e.get('name'), e.get('ts')) not in seen]
+    merged.sort(key=lambda e: e['ts'])
+    metadata = [
+        {'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': name}}
+        for pid, name in PROCESS_NAMES.items()
+    ]
+    TRACE_DIR.mkdir(parents=True, exist_ok=True)
+    write_atomic(trace_path(job_id), json.dumps({'traceEvents': metadata + merged, 'displayTimeUnit': 'ms',
+                                                 'otherData': {'job_id': str(job_id)}}))
+    prune_traces()
+
+def prune_traces():
+    """Drop traces past the age limit, then the oldest until under the count limit"""
+    cutoff = time.time() - TRACE_MAX_AGE_DAYS * 86400
+    entries = []
+    for path in TRACE_DIR.glob('*.json'):
+        try:
+            mtime = path.stat().st_mtime
+            if mtime < cutoff:
+                path.unlink()
+                continue
+        except OSError:
+            continue
+        entries.append((mtime, path))
+    for _, path in sorted(entries)[:max(0, len(entries) - TRACE_MAX_FILES)]:
+        try:
+            path.unlink()
+        except OSError:
+            pass
+
+def record_results(jobs: List[Dict]):
+    """
+    Complete the traces of jobs submitted from here: merge the spans the agent sent
+    with the result, and mark when the result was first seen
+    """
+    for job in jobs:
+        job_id = str(job.get('id'))
+        if job.get('status') != 'FINISHED' or not trace_path(job_id).exists():
+            continue
+        events = load_events(job_id)
+        if any(e['name'] == 'result' for e in events):
+            continue
+        trace = JobTrace(job_id, REQUESTER)
+        trace.mark('result')
+        merge_events(job_id, [e for e in job.get('trace') or [] if isinstance(e, dict) and 'ts' in e]
+                     + trace.events)
+
+def critical_path(events: List[Dict]) -> List[Dict]:
+    """
+    Walk the job's life from its first to its last event. A job's stages run one
+    after another, so the path is the spans in time order, with nested or overlapped
+    time counted once and the gaps between them (queueing, polling) made explicit
+
+    Returns:
+        Segments with 'name', 'pid', 'start' and 'dur' (microseconds); gaps have pid None
+    """
+    timed = sorted(
+        ({'name': e['name'], 'pid': e['pid'], 'start': e['ts'], 'end': e['ts'] + e.get('dur', 0)}
+         for e in events if e.get('ph') in ('X', 'i')),
+        key=lambda e: (e['start'], -e['end'])
+    )
+    path: List[Dict] = []
+    cursor: Optional[int] = None
+    previous = None
+    for event in timed:
+        if cursor is None:
+            cursor = event['start']
+        if event['end'] <= cursor and event['end'] > event['start']:
+            continue  # Nested inside time already on the path
+        if event['start'] - cursor >= MIN_GAP_US:
+            path.append({'name': f"wait ({previous} -> {event['name']})" if previous else 'wait',
+                         'pid': None, 'start': cursor, 'dur': event['start'] - cursor})
+        cursor = max(cursor, event['start'])
+        if event['end'] > cursor:
+            path.append({'name': event['name'], 'pid': event['pid'],
+                         'start': cursor, 'dur': event['end'] - cursor})
+            cursor = event['end']
+        previous = event['name']
+    return path